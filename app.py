@@ -1,24 +1,31 @@
-from flask import Flask, request, jsonify, redirect, session, url_for
+from flask import Flask, request, jsonify, Response, stream_with_context, send_from_directory
 from flask_cors import CORS
+from flask.json.provider import JSONProvider
+import orjson
 import os
-import json
+import importlib
+import glob
 import time
-from mailsense.auth import get_credentials
+from datetime import datetime
+from mailsense.progress import ProgressStore
+from mailsense.gmail import (get_valid_credentials, cache_credentials,
+                             save_user_credentials, acquire_client, release_client,
+                             ensure_dir, TOKENS_DIR)
 from dotenv import load_dotenv
-import importlib.util
-import sys
-import requests
 import asyncio
 import secrets
-import pickle
+import hashlib
+import threading
+from collections import OrderedDict
 from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 import urllib.parse
 import logging
 from logging.handlers import RotatingFileHandler
-from mailsense.storage import (read_file, write_file, append_to_file, 
-                               file_exists, read_pickle, write_pickle,
-                               list_files, delete_file, ensure_bucket_exists)
+from mailsense.storage import (read_file, write_file, file_exists,
+                               list_files, delete_file, ensure_bucket_exists,
+                               get_file_etag, write_file_if, get_file_modified,
+                               delete_files_older_than)
 
 # Configure logging
 log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
@@ -48,64 +55,221 @@ logger.addHandler(console_handler)
 logger.info("Loading environment variables")
 load_dotenv()
 
-# Import modules dynamically
-def import_module_from_file(module_name, file_path):
-    logger.info(f"Dynamically importing module {module_name} from {file_path}")
-    spec = importlib.util.spec_from_file_location(module_name, file_path)
-    module = importlib.util.module_from_spec(spec)
-    sys.modules[module_name] = module
-    spec.loader.exec_module(module)
-    return module
+class LazyModule:
+    """A module that's only imported on first attribute access."""
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            # A normal import holds the module's import lock, so threads that get
+            # here together wait for its body to finish instead of seeing a
+            # half-built module (importlib.util.LazyLoader isn't thread-safe before 3.12.3)
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
 
-# Import the necessary modules
+# Import the necessary modules (after the environment is loaded). findvoice and
+# generate pull in OpenAI and tiktoken, so they load on their first request.
 logger.info("Importing required modules")
-gmail_history = import_module_from_file("gmail_history", "gmail_history.py")
-findvoice = import_module_from_file("findvoice", "findvoice.py")
-generate = import_module_from_file("generate", "generate.py")
+import gmail_history
+findvoice = LazyModule('findvoice')
+generate = LazyModule('generate')
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider that parses and serializes with orjson."""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response without a str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+            mimetype="application/json"
+        )
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)  # Use orjson for request.json and jsonify
 CORS(app)  # Enable CORS for Chrome extension
 logger.info("Flask app initialized with CORS enabled")
 
 # Directory for user data
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "user_data")
-os.makedirs(DATA_DIR, exist_ok=True)
+ensure_dir(DATA_DIR)
 logger.info(f"User data directory created at {DATA_DIR}")
 
-# Add this to your Flask app initialization
-app.secret_key = secrets.token_hex(16)  # For session management
-logger.info("Flask secret key generated for session management")
+# Pre-create the local token directory so credential loads never need to mkdir
+ensure_dir(TOKENS_DIR)
+
+def load_client_secrets():
+    """Find and parse the OAuth client secrets. Returns (client_config, client_id)."""
+    # First, try to use environment variable
+    secret_content = os.environ.get('GOOGLE_CLIENT_SECRETS')
+    if secret_content:
+        logger.info("Using client secrets from environment variable")
+        client_info = orjson.loads(secret_content)
+    else:
+        # Fall back to looking for client secret files
+        logger.info("Looking for client secrets file on disk")
+        client_secret_files = glob.glob("client_secret*.json")
+        if not client_secret_files:
+            logger.warning("No client secrets file found - authentication will be unavailable")
+            return None, None
+        
+        client_secrets_file = client_secret_files[0]
+        logger.info(f"Using credentials file: {client_secrets_file}")
+        with open(client_secrets_file, 'rb') as f:
+            client_info = orjson.loads(f.read())
+    
+    # Check if this is a web or installed client
+    client_type = "web" if "web" in client_info else "installed"
+    client_id = client_info[client_type]['client_id']
+    logger.info(f"Using client type: {client_type}, client_id: {client_id[:8]}...")
+    
+    return client_info, client_id
+
+# OAuth client secrets don't change while the app is running, so parse them once
+CLIENT_CONFIG, CLIENT_ID = load_client_secrets()
+
+# Scopes requested from the user
+SCOPES = ('https://www.googleapis.com/auth/gmail.readonly',)
+
+# Per-user files in S3 shared by the fetch, analyze and generate steps
+SENT_EMAILS_FILE = "sent_emails.txt"
+VOICE_EXAMPLES_FILE = "filtered_voice_emails.txt"
+FETCH_PROGRESS_FILE = "email_fetch_progress.txt"
+EXTRACTION_STATS_FILE = "email_extraction_stats.txt"
+SENT_EMAILS_SHARDS_DIR = "sent_emails_shards"  # per-group output, merged into SENT_EMAILS_FILE
+
+# Only one fetch job per user runs at a time, across workers: the job holds a
+# lease in S3 and renews it after every group. A lease not renewed for
+# FETCH_LOCK_TTL seconds belongs to a job that died and can be taken over.
+FETCH_LOCK_FILE = "jobs/fetch.lock"
+FETCH_LOCK_TTL = 600
+
+# Use the redirect URI that's registered in Google Cloud Console. It's fixed
+# per deployment, so it's resolved here once rather than built per request
+OAUTH_REDIRECT_URI = os.environ.get('OAUTH_REDIRECT_URI', 'https://reelbrief.ai/oauth2callback')
+
+# Authorization URL with every parameter except the per-request state
+AUTH_URL_BASE = "https://accounts.google.com/o/oauth2/auth?" + urllib.parse.urlencode({
+    'client_id': CLIENT_ID or '',
+    'redirect_uri': OAUTH_REDIRECT_URI,
+    'scope': ' '.join(SCOPES),
+    'response_type': 'code',
+    'access_type': 'offline',
+    'prompt': 'consent'
+})
+
+# Add this to your Flask app initialization. Set SECRET_KEY when running more than
+# one worker so OAuth state signed by one worker verifies on another.
+app.secret_key = os.environ.get('SECRET_KEY') or secrets.token_hex(16)  # For session management
+logger.info("Flask secret key configured for session management")
+
+# Pending auth requests travel in the signed OAuth state itself, so nothing is
+# stored per request and any worker can complete the callback
+AUTH_REQUEST_TTL = 600  # seconds to complete the Google consent screen
+state_serializer = URLSafeTimedSerializer(app.secret_key, salt='oauth-state')
+
+# States already used for a callback are recorded in S3, written only if absent,
+# so a state can't be replayed against this or any other worker. A marker is only
+# needed while its state is within AUTH_REQUEST_TTL, so older ones are pruned.
+CONSUMED_STATES_DIR = "oauth_states"
 
-# Store pending auth requests
-auth_requests = {}
+def consume_state(user_id, state):
+    """Mark an OAuth state as used. Returns False if it had already been used."""
+    state_hash = hashlib.sha256(state.encode('utf-8')).hexdigest()
+    if write_file_if(user_id, f"{CONSUMED_STATES_DIR}/{state_hash}", "") is None:
+        return False
+    
+    # Once past the TTL a state fails its signature check anyway, so its marker can go
+    try:
+        delete_files_older_than(user_id, f"{CONSUMED_STATES_DIR}/", AUTH_REQUEST_TTL)
+    except Exception as e:
+        logger.error(f"Error pruning used OAuth states for user_id {user_id}: {e}")
+    return True
 
 # Ensure S3 bucket exists when app starts
 logger.info("Ensuring S3 bucket exists")
 ensure_bucket_exists()
 
 # For async job processing
-import threading
 import uuid
 
 # Dictionary to store running jobs
 email_fetch_jobs = {}
 
+# Job progress waiting to be written to S3 by the flusher thread, newest only:
+# job_id -> (user_id, progress). Status changes are written synchronously.
+JOB_PROGRESS_FLUSH_INTERVAL = 1.0
+pending_job_progress = {}
+pending_job_progress_lock = threading.Lock()
+job_progress_pending = threading.Event()
+# Serializes status file writes, so a stale progress update can't overwrite a status change
+job_status_write_lock = threading.Lock()
+
+# Persistent event loop for coroutine work (findvoice), running on its own
+# thread so requests don't create and tear down a loop on every call
+event_loop = asyncio.new_event_loop()
+threading.Thread(target=event_loop.run_forever, name="event-loop", daemon=True).start()
+logger.info("Background event loop started")
+
+def run_coroutine(coro):
+    """Run a coroutine on the shared background event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, event_loop).result()
+
+# Recently generated texts for deterministic (temperature 0) requests, keyed
+# by a hash of the request and the examples file version
+GENERATED_CACHE_SIZE = 1024
+generated_cache = OrderedDict()
+generated_cache_lock = threading.Lock()
+
+def generated_cache_key(*parts):
+    """Fingerprint the inputs of a generation request."""
+    return hashlib.blake2b(orjson.dumps(parts, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
+def get_cached_generation(key):
+    """Return a cached generated text, or None on a miss."""
+    with generated_cache_lock:
+        text = generated_cache.get(key)
+        if text is not None:
+            generated_cache.move_to_end(key)
+        return text
+
+def cache_generation(key, text):
+    """Store a generated text, evicting the least recently used entry when full."""
+    with generated_cache_lock:
+        generated_cache[key] = text
+        generated_cache.move_to_end(key)
+        if len(generated_cache) > GENERATED_CACHE_SIZE:
+            generated_cache.popitem(last=False)
+
+# API information served by the root endpoint, serialized once at import
+API_INFO_JSON = orjson.dumps({
+    "name": "MailSense API",
+    "version": "1.0",
+    "endpoints": [
+        {"path": "/api/authenticate", "method": "POST", "description": "Start OAuth flow for authentication"},
+        {"path": "/oauth2callback", "method": "GET", "description": "OAuth callback handler"},
+        {"path": "/api/fetch-history", "method": "POST", "description": "Fetch email history"},
+        {"path": "/api/analyze-voice", "method": "POST", "description": "Analyze writing voice"},
+        {"path": "/api/job-status", "method": "GET", "description": "Check the status of a background job"},
+        {"path": "/api/generate-content", "method": "POST", "description": "Generate content based on voice"}
+    ]
+})
+
 @app.route('/')
 def index():
     """Root endpoint that provides API information"""
     logger.info("Root endpoint accessed")
-    api_info = {
-        "name": "MailSense API",
-        "version": "1.0",
-        "endpoints": [
-            {"path": "/api/authenticate", "method": "POST", "description": "Start OAuth flow for authentication"},
-            {"path": "/oauth2callback", "method": "GET", "description": "OAuth callback handler"},
-            {"path": "/api/fetch-history", "method": "POST", "description": "Fetch email history"},
-            {"path": "/api/analyze-voice", "method": "POST", "description": "Analyze writing voice"},
-            {"path": "/api/generate-content", "method": "POST", "description": "Generate content based on voice"}
-        ]
-    }
-    return jsonify(api_info)
+    return Response(API_INFO_JSON, mimetype='application/json')
 
 @app.route('/api/authenticate', methods=['POST'])
 def authenticate():
@@ -118,79 +282,29 @@ def authenticate():
         
         # If no user_id provided, create one
         if not user_id:
-            user_id = f"user_{secrets.token_hex(8)}"
+            user_id = f"user_{secrets.token_urlsafe(8)}"
             logger.info(f"Created new user_id: {user_id}")
         else:
             logger.info(f"Using provided user_id: {user_id}")
         
-        # Create a state token to prevent CSRF
-        state = secrets.token_hex(16)
-        logger.info(f"Generated state token: {state}")
-        
-        # Look for client secrets in environment or file
-        client_secrets_file = None
-        
-        # First, try to use environment variable
-        secret_content = os.environ.get('GOOGLE_CLIENT_SECRETS')
-        if secret_content:
-            logger.info("Using client secrets from environment variable")
-            # Write the content to a temporary file
-            secrets_path = os.path.join(os.getcwd(), "client_secret_temp.json")
-            with open(secrets_path, 'w') as f:
-                f.write(secret_content)
-            client_secrets_file = secrets_path
-        else:
-            # Fall back to looking for client secret files
-            logger.info("Looking for client secrets file on disk")
-            import glob
-            client_secret_files = glob.glob("client_secret*.json")
-            if client_secret_files:
-                client_secrets_file = client_secret_files[0]
-                logger.info(f"Found client secrets file: {client_secrets_file}")
-        
-        if not client_secrets_file:
+        # Client secrets are parsed once at startup
+        if not CLIENT_CONFIG:
             logger.error("No client secrets file found")
             return jsonify({"success": False, "message": "No client secrets file found"}), 400
         
-        logger.info(f"Using credentials file: {client_secrets_file}")
-        
-        # Read client_id from client secrets file
-        with open(client_secrets_file, 'r') as f:
-            client_info = json.load(f)
-            # Check if this is a web or installed client
-            client_type = "web" if "web" in client_info else "installed"
-            client_id = client_info[client_type]['client_id']
-            logger.info(f"Using client type: {client_type}, client_id: {client_id[:8]}...")
-        
-        # Create the authorization URL
-        SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
-        
-        # Use the redirect URI that's registered in Google Cloud Console
-        redirect_uri = 'https://reelbrief.ai/oauth2callback'
-        
-        logger.info(f"Using redirect URI: {redirect_uri}")
-        
-        # Store user_id with auth request
-        auth_requests[state] = {
-            'client_secrets_file': client_secrets_file, 
+        # Sign the auth request into the state token to prevent CSRF
+        state = state_serializer.dumps({
             'return_url': request.headers.get('Referer'),
             'user_id': user_id,
-            'redirect_uri': redirect_uri
-        }
-        logger.info(f"Stored auth request for state: {state}")
-        
-        # Build authorization URL
-        params = {
-            'client_id': client_id,
-            'redirect_uri': redirect_uri,
-            'scope': ' '.join(SCOPES),
-            'response_type': 'code',
-            'state': state,
-            'access_type': 'offline',
-            'prompt': 'consent'
-        }
+            # The extension closes the auth tab itself and doesn't need the success page
+            'extension': data.get('client') == 'extension',
+            # Makes every state unique, so consumed states can be told apart
+            'nonce': secrets.token_urlsafe(8)
+        })
+        logger.info(f"Generated state token for user_id: {user_id}")
         
-        auth_url = f"https://accounts.google.com/o/oauth2/auth?{urllib.parse.urlencode(params)}"
+        # Build authorization URL (the signed state is URL-safe, so it needs no encoding)
+        auth_url = f"{AUTH_URL_BASE}&state={state}"
         logger.info(f"Generated auth URL: {auth_url[:60]}...")
         
         # Return the URL - extension will open this in a new tab
@@ -202,6 +316,10 @@ def authenticate():
         logger.error(traceback_str)
         return jsonify({"success": False, "message": str(e)}), 400
 
+# Page shown after a successful OAuth callback (static/oauth_success.html) only
+# changes between deploys, so browsers may cache it
+OAUTH_SUCCESS_MAX_AGE = 3600
+
 # Add a callback endpoint for OAuth
 @app.route('/oauth2callback')
 def oauth_callback():
@@ -213,22 +331,29 @@ def oauth_callback():
         return f"Error: {error}"
     
     state = request.args.get('state')
-    if not state or state not in auth_requests:
-        logger.error(f"Invalid state parameter: {state}")
+    try:
+        auth_info = state_serializer.loads(state, max_age=AUTH_REQUEST_TTL) if state else None
+    except BadSignature:
+        auth_info = None
+    if auth_info is None:
+        logger.error(f"Invalid or expired state parameter: {state}")
         return "Invalid state parameter"
     
-    auth_info = auth_requests.pop(state)
     code = request.args.get('code')
     user_id = auth_info.get('user_id', 'default')
+    if not consume_state(user_id, state):
+        logger.error(f"State parameter already used: {state}")
+        return "Invalid state parameter"
+    
     logger.info(f"Processing OAuth callback for user_id: {user_id}, state: {state}")
     
     try:
         # Create Flow instance with client secrets file
-        logger.info(f"Creating OAuth flow with redirect URI: {auth_info['redirect_uri']}")
-        flow = Flow.from_client_secrets_file(
-            auth_info['client_secrets_file'],
-            scopes=['https://www.googleapis.com/auth/gmail.readonly'],
-            redirect_uri=auth_info['redirect_uri']
+        logger.info(f"Creating OAuth flow with redirect URI: {OAUTH_REDIRECT_URI}")
+        flow = Flow.from_client_config(
+            CLIENT_CONFIG,
+            scopes=SCOPES,
+            redirect_uri=OAUTH_REDIRECT_URI
         )
         
         # Exchange code for credentials
@@ -238,36 +363,20 @@ def oauth_callback():
         
         # Save the credentials to S3 instead of local file
         logger.info(f"Saving credentials to S3 for user_id: {user_id}")
-        credentials_pickle = pickle.dumps(credentials)
-        write_pickle(user_id, "gmail_credentials.pickle", credentials)
+        save_user_credentials(user_id, credentials)
+        cache_credentials(user_id, credentials)
         logger.info("Credentials saved successfully")
         
+        # The extension closes the tab once auth-status reports success
+        if auth_info.get('extension'):
+            logger.info("Returning empty response to extension-initiated flow")
+            return '', 204
+        
         # Return success page with auto-close script
         logger.info("Returning success page to user")
-        return """
-        <html>
-        <head>
-            <title>Authentication Successful</title>
-            <style>
-                body { font-family: Arial, sans-serif; text-align: center; padding-top: 50px; }
-                .success { color: green; }
-                .container { max-width: 600px; margin: 0 auto; }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1 class="success">Authentication Successful!</h1>
-                <p>You can now close this window and return to the extension.</p>
-            </div>
-            <script>
-                // Send message to extension that auth is complete
-                setTimeout(function() {
-                    window.close();
-                }, 3000);
-            </script>
-        </body>
-        </html>
-        """
+        response = send_from_directory(app.static_folder, 'oauth_success.html', max_age=OAUTH_SUCCESS_MAX_AGE)
+        response.cache_control.public = True
+        return response
     except Exception as e:
         logger.error(f"Error exchanging code: {str(e)}")
         return f"Error exchanging code: {str(e)}"
@@ -280,30 +389,15 @@ def auth_status():
         user_id = request.args.get('user_id', 'default')
         logger.info(f"Checking auth status for user_id: {user_id}")
         
-        # Check if credentials exist in S3 instead of local file
-        credentials_file = "gmail_credentials.pickle"
-        if file_exists(user_id, credentials_file):
-            logger.info(f"Credentials file found for user_id: {user_id}")
-            try:
-                # Try to load credentials to verify they're valid
-                creds = read_pickle(user_id, credentials_file)
-                
-                if creds and creds.valid:
-                    logger.info(f"Valid credentials found for user_id: {user_id}")
-                    return jsonify({"authenticated": True})
-                elif creds and creds.expired and creds.refresh_token:
-                    logger.info(f"Expired credentials found for user_id: {user_id}, attempting refresh")
-                    try:
-                        creds.refresh(Request())
-                        # Update refreshed credentials in S3
-                        logger.info(f"Credentials refreshed successfully for user_id: {user_id}")
-                        write_pickle(user_id, credentials_file, creds)
-                        return jsonify({"authenticated": True})
-                    except Exception as refresh_error:
-                        logger.error(f"Error refreshing credentials: {refresh_error}")
-            except Exception as e:
-                logger.error(f"Error reading credentials from S3: {e}")
-                    
+        # Served from the in-process cache when possible; otherwise read from S3
+        # and refreshed, with concurrent polls for the same user coalesced
+        try:
+            if get_valid_credentials(user_id):
+                logger.info(f"Valid credentials found for user_id: {user_id}")
+                return jsonify({"authenticated": True})
+        except Exception as e:
+            logger.error(f"Error loading credentials: {e}")
+        
         logger.info(f"No valid credentials found for user_id: {user_id}")
         return jsonify({"authenticated": False})
     except Exception as e:
@@ -323,12 +417,26 @@ def start_fetch_history():
         before_date = data.get('before_date', '2022/01/01')
         email_limit = int(data.get('limit', 1000))
         
+        # Reject malformed dates before they end up in a Gmail query
+        try:
+            for date in (after_date, before_date):
+                datetime.strptime(date, '%Y/%m/%d')
+        except (TypeError, ValueError):
+            logger.error(f"Invalid date range: {after_date} - {before_date}")
+            return jsonify({"success": False, "message": "Dates must be in YYYY/MM/DD format"}), 400
+        
         logger.info(f"Fetch parameters - after_date: {after_date}, before_date: {before_date}, limit: {email_limit}")
         
         # Generate a unique job ID
         job_id = str(uuid.uuid4())
         logger.info(f"Generated job_id: {job_id} for user_id: {user_id}")
         
+        # Two jobs for the same user would fetch the same emails and merge each other's shards
+        lock_etag = acquire_fetch_lock(user_id, job_id)
+        if lock_etag is None:
+            logger.warning(f"Fetch already running for user_id: {user_id}")
+            return jsonify({"success": False, "message": "An email fetch is already running for this user"}), 409
+        
         # Store job parameters and initial status
         job_info = {
             'job_id': job_id,
@@ -349,19 +457,20 @@ def start_fetch_history():
         }
         
         # Store job info in S3
-        write_file(user_id, f"jobs/{job_id}/status.json", json.dumps(job_info))
+        write_file(user_id, f"jobs/{job_id}/status.json", orjson.dumps(job_info).decode('utf-8'))
         
         # Start the fetch in a background thread
         thread = threading.Thread(
             target=fetch_emails_async,
-            args=(job_id, user_id, after_date, before_date, email_limit)
+            args=(job_id, user_id, after_date, before_date, email_limit, lock_etag)
         )
         thread.daemon = True  # Make thread a daemon so it doesn't block app shutdown
         
-        # Store the thread in memory
+        # Store the thread in memory, with an event set when the job finishes
         email_fetch_jobs[job_id] = {
             'thread': thread,
-            'info': job_info
+            'info': job_info,
+            'done': threading.Event()
         }
         
         # Start the thread
@@ -389,29 +498,33 @@ def fetch_history_status():
         
         logger.info(f"Checking status for job_id: {job_id}, user_id: {user_id}")
         
-        # Check if job status file exists in S3
+        # Read job status from S3
         job_status_file = f"jobs/{job_id}/status.json"
         
-        if not file_exists(user_id, job_status_file):
+        try:
+            job_status_content = read_file(user_id, job_status_file)
+        except FileNotFoundError:
             logger.error(f"Job status file not found for job_id: {job_id}")
             return jsonify({
                 "success": False,
                 "message": f"Job not found with ID: {job_id}"
             }), 404
         
-        # Read job status from S3
-        job_status_content = read_file(user_id, job_status_file)
-        job_status = json.loads(job_status_content)
+        job_status = orjson.loads(job_status_content)
         
         # Check if job is completed and output file exists
-        output_file = "sent_emails.txt"
+        output_file = SENT_EMAILS_FILE
         output_exists = file_exists(user_id, output_file)
         
         # Get stats if available
-        stats_file = "email_extraction_stats.txt"
+        stats_file = EXTRACTION_STATS_FILE
         stats = {}
-        if file_exists(user_id, stats_file):
+        try:
             stats_content = read_file(user_id, stats_file)
+        except FileNotFoundError:
+            stats_content = None
+        
+        if stats_content is not None:
             stats_lines = stats_content.split("\n")
             for line in stats_lines:
                 if ":" in line:
@@ -448,30 +561,33 @@ def fetch_history_status():
         logger.error(f"Error checking fetch history status: {str(e)}", exc_info=True)
         return jsonify({"success": False, "message": str(e)}), 400
 
-def fetch_emails_async(job_id, user_id, after_date, before_date, email_limit):
+def fetch_emails_async(job_id, user_id, after_date, before_date, email_limit, lock_etag):
     """Asynchronously fetch emails from Gmail - runs in background thread"""
     logger.info(f"Starting async email fetch for job_id: {job_id}, user_id: {user_id}")
     
     # Update job status to in_progress
     update_job_status(job_id, user_id, "in_progress")
     
+    client = None
+    processed_ids = None
     try:
         # Set the query to get sent emails from the specified date range
-        query = f"in:sent after:{after_date} before:{before_date}"
+        query = f"in:sent after:{after_date} before:{before_date} {gmail_history.SENT_QUERY_FILTERS}".rstrip()
         
-        # Create the Gmail client
-        client = gmail_history.GmailClient(user_id)
+        # Get the Gmail client (reused from this user's previous job when possible)
+        client = acquire_client(user_id)
         
         # Prepare output file
-        output_file = f"sent_emails.txt"
+        output_file = SENT_EMAILS_FILE
         
-        # Check if we have a progress file in S3
-        progress_file = f"email_fetch_progress.txt"
-        processed_ids = set()
+        # Load progress from S3 (via the local mirror when it's up to date)
+        processed_ids = ProgressStore(user_id, FETCH_PROGRESS_FILE)
         
-        if file_exists(user_id, progress_file):
-            progress_content = read_file(user_id, progress_file)
-            processed_ids = set(line.strip() for line in progress_content.split('\n') if line.strip())
+        # Shards left by an interrupted run may hold emails whose progress was
+        # never saved; merging them records those emails as processed too
+        merge_email_shards(user_id, processed_ids)
+        
+        if len(processed_ids):
             logger.info(f"Resuming from previous run, {len(processed_ids)} emails already processed.")
         else:
             logger.info(f"No progress file found, starting fresh fetch for user_id: {user_id}")
@@ -482,136 +598,113 @@ def fetch_emails_async(job_id, user_id, after_date, before_date, email_limit):
         actual_processed = 0
         limit_reached = False
         
-        # Loop to handle pagination
-        while True:
-            # Check if we've reached the limit
-            if total_fetched >= email_limit:
-                logger.info(f"Reached email processing limit of {email_limit}")
-                limit_reached = True
-                break
-            
-            # Fetch a batch of emails
+        # List the matching message IDs first. ID-only pages are cheap (up to 500
+        # IDs each), and knowing every ID up front lets the full-message fetches
+        # run as many concurrent batches instead of one list page at a time
+        msg_ids = []
+        while total_fetched < email_limit:
             try:
-                logger.info(f"Fetching batch of messages, page_token: {page_token}")
-                results = client.service.users().messages().list(
+                logger.info(f"Listing message IDs, page_token: {page_token}")
+                results = gmail_history.execute_with_retry(client.service.users().messages().list(
                     userId='me',
                     q=query,
-                    maxResults=min(100, email_limit - total_fetched),  # Don't fetch more than we need
-                    pageToken=page_token
-                ).execute()
+                    maxResults=min(500, email_limit - total_fetched),  # Don't list more than we need
+                    pageToken=page_token,
+                    fields='messages/id,nextPageToken'
+                ))
             except Exception as e:
                 logger.error(f"Error fetching messages: {e}")
                 update_job_status(job_id, user_id, "failed", error=str(e))
                 return
             
             messages = results.get('messages', [])
-            if not messages:
-                logger.info("No more messages found in Gmail")
+            msg_ids.extend(message['id'] for message in messages)
+            total_fetched += len(messages)
+            
+            page_token = results.get('nextPageToken')
+            if not messages or not page_token:
+                logger.info("No more pages of results available")
                 break
-                
-            batch_size = len(messages)
+        
+        if total_fetched >= email_limit and page_token:
+            logger.info(f"Reached email processing limit of {email_limit}")
+            limit_reached = True
+        
+        # Skip messages saved by a previous run
+        pending_ids = processed_ids.unprocessed(msg_ids)
+        logger.info(f"Found {total_fetched} emails, {len(pending_ids)} still to fetch")
+        
+        # Fetch full messages in groups large enough to keep every batch worker busy
+        group_size = gmail_history.FETCH_BATCH_SIZE * gmail_history.FETCH_CONCURRENCY
+        for group_start in range(0, len(pending_ids), group_size):
+            group_ids = pending_ids[group_start:group_start + group_size]
+            batch_size = len(group_ids)
             logger.info(f"Processing batch of {batch_size} emails...")
+            fetched = gmail_history.fetch_messages(client, group_ids)
+            
+            # Buffer the group's output and progress so each S3 object is rewritten once per group
+            batch_entries = []
+            batch_ids = []
             
-            # Process each message
-            for i, message in enumerate(messages):
-                # Check if we've reached the limit
-                if total_fetched >= email_limit:
-                    logger.info(f"Reached email processing limit of {email_limit} during batch")
-                    limit_reached = True
-                    break
-                    
-                total_fetched += 1
-                msg_id = message['id']
+            # Parse the messages across worker processes, then collect them in order
+            for i, (msg_id, entry, error) in enumerate(gmail_history.parse_messages(fetched)):
+                if error:
+                    logger.error(f"Error processing message {msg_id}: {error}")
+                    continue
                 
-                # Skip if already processed
-                if msg_id in processed_ids:
-                    logger.debug(f"Skipping already processed message: {msg_id}")
+                # Skip emails with empty content after extraction
+                if entry is None:
+                    logger.debug(f"Skipping email with no original content: {msg_id}")
+                    # Mark as processed to avoid reprocessing
+                    batch_ids.append(msg_id)
                     continue
                 
-                try:
-                    # Get full message details
-                    logger.debug(f"Fetching full message details for ID: {msg_id}")
-                    msg = client.service.users().messages().get(
-                        userId='me', id=msg_id, format='full'
-                    ).execute()
-                    
-                    # Extract email details
-                    headers = msg['payload']['headers']
-                    subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-                    to = next((h['value'] for h in headers if h['name'].lower() == 'to'), 'Unknown')
-                    date = next((h['value'] for h in headers if h['name'].lower() == 'date'), 'Unknown')
-                    
-                    logger.debug(f"Processing email - Date: {date}, Subject: {subject[:30]}...")
-                    
-                    # Extract body
-                    body = ""
-                    if 'parts' in msg['payload']:
-                        for part in msg['payload']['parts']:
-                            if part['mimeType'] == 'text/plain':
-                                body = gmail_history.decode_body(part['body'].get('data', ''))
-                                logger.debug("Extracted plain text body")
-                                break
-                            elif part['mimeType'] == 'text/html' and not body:
-                                body = gmail_history.clean_html(gmail_history.decode_body(part['body'].get('data', '')))
-                                logger.debug("Extracted and cleaned HTML body")
-                    elif 'body' in msg['payload'] and 'data' in msg['payload']['body']:
-                        body = gmail_history.decode_body(msg['payload']['body'].get('data', ''))
-                        logger.debug("Extracted body from payload")
-                    
-                    # Extract only the user's original content
-                    your_content = gmail_history.extract_your_content(body, date)
-                    
-                    # Skip emails with empty content after extraction
-                    if not your_content.strip():
-                        logger.debug(f"Skipping email with no original content: {msg_id}")
-                        # Mark as processed to avoid reprocessing
-                        append_to_file(user_id, progress_file, f"{msg_id}\n")
-                        processed_ids.add(msg_id)
-                        continue
-                    
-                    # Write to S3 instead of local file
-                    email_content = f"Email ID: {msg_id}\nDate: {date}\nTo: {to}\nSubject: {subject}\nYour Content:\n{your_content}\n{'='*80}\n\n"
-                    append_to_file(user_id, output_file, email_content)
-                    logger.debug(f"Saved email content to S3 for ID: {msg_id}")
-                    
-                    # Mark as processed in S3
-                    append_to_file(user_id, progress_file, f"{msg_id}\n")
-                    processed_ids.add(msg_id)
-                    actual_processed += 1
-                    
-                    # Update job status every 10 emails
-                    if (i + 1) % 10 == 0:
-                        update_job_progress(job_id, user_id, total_fetched, actual_processed, limit_reached)
-                        logger.info(f"  Processed {i + 1}/{batch_size} in current batch, saved {actual_processed} emails")
-                    
-                except Exception as e:
-                    logger.error(f"Error processing message {msg_id}: {e}")
+                # Add the formatted email to the group's output
+                batch_entries.append((msg_id, entry))
                 
-                # Sleep briefly to avoid hitting rate limits
-                time.sleep(0.05)
+                # Mark as processed
+                batch_ids.append(msg_id)
+                actual_processed += 1
+                
+                # Update job status every 10 emails
+                if (i + 1) % 10 == 0:
+                    update_job_progress(job_id, user_id, total_fetched, actual_processed, limit_reached)
+                    logger.info(f"  Processed {i + 1}/{batch_size} in current batch, saved {actual_processed} emails")
             
-            # Check if limit was reached during batch processing
-            if limit_reached:
-                break
+            # Make sure no other job has taken over before writing anything
+            lock_etag = renew_fetch_lock(user_id, job_id, lock_etag)
+            if lock_etag is None:
+                raise Exception("Another fetch job took over this user's fetch")
             
-            logger.info(f"Batch complete. Total processed: {total_fetched}, saved: {actual_processed} with user content.")
+            # Write the group to its own shard (no read-modify-write of the growing
+            # output), content before progress so a crash only re-fetches. One JSON
+            # [msg_id, entry] per line, so nothing the user wrote can break a record
+            if batch_entries:
+                write_file(user_id, f"{SENT_EMAILS_SHARDS_DIR}/{time.time_ns():020d}.jsonl",
+                           "".join(orjson.dumps(pair).decode('utf-8') + "\n" for pair in batch_entries))
+            processed_ids.add(batch_ids)
+            
+            logger.info(f"Batch complete. Total processed: {group_start + batch_size}/{len(pending_ids)}, saved: {actual_processed} with user content.")
             
             # Update job status after each batch
             update_job_progress(job_id, user_id, total_fetched, actual_processed, limit_reached)
-            
-            # Check if there are more pages
-            page_token = results.get('nextPageToken')
-            if not page_token:
-                logger.info("No more pages of results available")
-                break
+        
+        # Join this run's shards onto the output in the order they were written,
+        # as long as no other job has taken over the output meanwhile
+        lock_etag = renew_fetch_lock(user_id, job_id, lock_etag)
+        if lock_etag is None:
+            raise Exception("Another fetch job took over this user's fetch")
+        merge_email_shards(user_id, processed_ids)
         
         # Add stats about the extraction to S3
-        stats_content = f"Total emails fetched: {total_fetched}\n"
-        stats_content += f"Emails with user content extracted: {actual_processed}\n"
-        stats_content += f"Extraction date: {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
-        stats_content += f"Limit reached: {limit_reached}\n"
-        stats_content += f"Email limit: {email_limit}\n"
-        write_file(user_id, "email_extraction_stats.txt", stats_content)
+        stats_content = (
+            f"Total emails fetched: {total_fetched}\n"
+            f"Emails with user content extracted: {actual_processed}\n"
+            f"Extraction date: {time.strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"Limit reached: {limit_reached}\n"
+            f"Email limit: {email_limit}\n"
+        )
+        write_file(user_id, EXTRACTION_STATS_FILE, stats_content)
         
         # Update job status to completed
         update_job_status(
@@ -630,38 +723,131 @@ def fetch_emails_async(job_id, user_id, after_date, before_date, email_limit):
     except Exception as e:
         logger.error(f"Error in async fetch_emails: {str(e)}", exc_info=True)
         update_job_status(job_id, user_id, "failed", error=str(e))
+    finally:
+        # Close the progress database on every exit, so failed jobs don't leak it
+        if processed_ids is not None:
+            processed_ids.close()
+        if lock_etag:
+            release_fetch_lock(user_id, lock_etag)
+        if client:
+            release_client(client)
 
-def update_job_status(job_id, user_id, status, error=None, progress=None):
-    """Update the status of a job in S3"""
-    logger.info(f"Updating job status for job_id: {job_id} to {status}")
+def acquire_fetch_lock(user_id, job_id):
+    """Claim a user's fetch lease for job_id. Returns its ETag, or None if another live job holds it."""
+    etag = write_file_if(user_id, FETCH_LOCK_FILE, job_id)
+    if etag:
+        return etag
     
-    job_status_file = f"jobs/{job_id}/status.json"
+    held = get_file_modified(user_id, FETCH_LOCK_FILE)
+    if held is None:
+        # Released since we tried
+        return write_file_if(user_id, FETCH_LOCK_FILE, job_id)
+    held_etag, last_modified = held
+    if time.time() - last_modified < FETCH_LOCK_TTL:
+        return None
     
-    # Read current job info if it exists
-    current_job_info = {}
-    if file_exists(user_id, job_status_file):
-        try:
-            job_info_content = read_file(user_id, job_status_file)
-            current_job_info = json.loads(job_info_content)
-        except Exception as e:
-            logger.error(f"Error reading job status: {e}")
+    # Only one of several jobs taking over the same stale lease gets it
+    logger.warning(f"Taking over stale fetch lock for user_id: {user_id}")
+    return write_file_if(user_id, FETCH_LOCK_FILE, job_id, etag=held_etag)
+
+def renew_fetch_lock(user_id, job_id, lock_etag):
+    """Renew a user's fetch lease. Returns its new ETag, or None if another job took it over."""
+    return write_file_if(user_id, FETCH_LOCK_FILE, job_id, etag=lock_etag)
+
+def release_fetch_lock(user_id, lock_etag):
+    """Release a user's fetch lease, unless another job has taken it over since lock_etag."""
+    held = get_file_modified(user_id, FETCH_LOCK_FILE)
+    if held is not None and held[0] == lock_etag:
+        delete_file(user_id, FETCH_LOCK_FILE)
+
+def merge_email_shards(user_id, processed_ids):
+    """Append any per-group email shards to the sent emails file, oldest first.
     
-    # Update job info
-    current_job_info['status'] = status
-    current_job_info['last_updated'] = time.time()
+    Emails the file already has are skipped, and every merged email is recorded
+    in processed_ids before its shard is deleted, so a shard whose progress was
+    never saved can't put the same email in the file twice.
+    """
+    shards = sorted(list_files(user_id, f"{SENT_EMAILS_SHARDS_DIR}/"))
+    if not shards:
+        return
+    logger.info(f"Merging {len(shards)} email shards into {SENT_EMAILS_FILE} for user_id: {user_id}")
     
-    if error:
-        current_job_info['error'] = error
+    try:
+        content = read_file(user_id, SENT_EMAILS_FILE)
+    except FileNotFoundError:
+        content = ""
+    seen = set(gmail_history.EMAIL_ID_RE.findall(content))
+    parts = [content]
+    merged_ids = []
+    for shard in shards:
+        # JSON escapes newlines inside strings; split on "\n" only, since
+        # splitlines() would also break on U+2028 and friends that orjson leaves raw
+        for line in read_file(user_id, shard).split("\n"):
+            if not line:
+                continue
+            msg_id, entry = orjson.loads(line)
+            if msg_id not in seen:
+                seen.add(msg_id)
+                parts.append(entry)
+            merged_ids.append(msg_id)
+    write_file(user_id, SENT_EMAILS_FILE, "".join(parts))
+    processed_ids.add(processed_ids.unprocessed(list(dict.fromkeys(merged_ids))))
     
-    if progress:
-        current_job_info['progress'] = progress
+    # Only remove the shards once their content is safely in the file
+    for shard in shards:
+        delete_file(user_id, shard)
+
+def load_job_info(job_id, user_id):
+    """Get a job's current info, from memory if this process runs the job, otherwise from S3"""
+    if job_id in email_fetch_jobs:
+        return email_fetch_jobs[job_id]['info']
     
-    # Write updated job info to S3
-    write_file(user_id, job_status_file, json.dumps(current_job_info))
+    # Read current job info if it exists
+    try:
+        return orjson.loads(read_file(user_id, f"jobs/{job_id}/status.json"))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Error reading job status: {e}")
+    return {}
+
+def update_job_status(job_id, user_id, status, error=None, progress=None):
+    """Update the status of a job in S3"""
+    logger.info(f"Updating job status for job_id: {job_id} to {status}")
+    
+    job_status_file = f"jobs/{job_id}/status.json"
+    
+    # Status changes are written right away; holding the write lock keeps a
+    # queued progress update from landing on top of this one
+    with job_status_write_lock:
+        with pending_job_progress_lock:
+            pending = pending_job_progress.pop(job_id, None)
+        
+        current_job_info = load_job_info(job_id, user_id)
+        
+        # Update job info
+        current_job_info['status'] = status
+        current_job_info['last_updated'] = time.time()
+        
+        if error:
+            current_job_info['error'] = error
+        
+        if progress:
+            current_job_info['progress'] = progress
+        elif pending:
+            # Carry over progress that hadn't been flushed yet
+            current_job_info['progress'] = pending[1]
+        
+        # Write updated job info to S3
+        write_file(user_id, job_status_file, orjson.dumps(current_job_info).decode('utf-8'))
     
     # Also update in-memory tracking if job is in memory
     if job_id in email_fetch_jobs:
         email_fetch_jobs[job_id]['info'] = current_job_info
+        
+        # Wake up anyone waiting on the job (legacy fetch-history endpoint)
+        if status in ('completed', 'failed'):
+            email_fetch_jobs[job_id]['done'].set()
 
 def update_job_progress(job_id, user_id, total_fetched, actual_processed, limit_reached):
     """Update only the progress part of job status"""
@@ -671,29 +857,53 @@ def update_job_progress(job_id, user_id, total_fetched, actual_processed, limit_
         'limit_reached': limit_reached
     }
     
-    # Get current job info
+    # Update in-memory tracking if job is in memory
+    if job_id in email_fetch_jobs:
+        email_fetch_jobs[job_id]['info']['progress'] = progress
+        email_fetch_jobs[job_id]['info']['last_updated'] = time.time()
+    
+    # Queue the write to S3 for the flusher thread, replacing any older update
+    with pending_job_progress_lock:
+        pending_job_progress[job_id] = (user_id, progress)
+    job_progress_pending.set()
+
+def write_job_progress(job_id, user_id, progress):
+    """Write a job's progress into its status file in S3"""
     job_status_file = f"jobs/{job_id}/status.json"
     
-    # Read current job info if it exists
-    current_job_info = {}
-    if file_exists(user_id, job_status_file):
-        try:
-            job_info_content = read_file(user_id, job_status_file)
-            current_job_info = json.loads(job_info_content)
-        except Exception as e:
-            logger.error(f"Error reading job status: {e}")
+    # A copy, so the in-memory info isn't set back to this (possibly older) progress
+    current_job_info = dict(load_job_info(job_id, user_id))
     
     # Update just the progress
     current_job_info['progress'] = progress
     current_job_info['last_updated'] = time.time()
     
     # Write updated job info to S3
-    write_file(user_id, job_status_file, json.dumps(current_job_info))
-    
-    # Also update in-memory tracking if job is in memory
-    if job_id in email_fetch_jobs:
-        email_fetch_jobs[job_id]['info']['progress'] = progress
-        email_fetch_jobs[job_id]['info']['last_updated'] = time.time()
+    write_file(user_id, job_status_file, orjson.dumps(current_job_info).decode('utf-8'))
+
+def flush_job_progress():
+    """Write queued progress to S3, at most once per JOB_PROGRESS_FLUSH_INTERVAL per job"""
+    while True:
+        job_progress_pending.wait()
+        # Let updates pile up so only the newest one per job is written
+        time.sleep(JOB_PROGRESS_FLUSH_INTERVAL)
+        job_progress_pending.clear()
+        
+        with pending_job_progress_lock:
+            job_ids = list(pending_job_progress)
+        for job_id in job_ids:
+            with job_status_write_lock:
+                # Skip jobs whose status was written (with this progress) meanwhile
+                with pending_job_progress_lock:
+                    pending = pending_job_progress.pop(job_id, None)
+                if pending is None:
+                    continue
+                try:
+                    write_job_progress(job_id, *pending)
+                except Exception as e:
+                    logger.error(f"Error writing progress for job_id {job_id}: {e}")
+
+threading.Thread(target=flush_job_progress, name="job-progress-flusher", daemon=True).start()
 
 # Keep the existing fetch-history endpoint for backward compatibility
 @app.route('/api/fetch-history', methods=['POST'])
@@ -705,8 +915,10 @@ def fetch_history():
         data = request.json
         user_id = data.get('user_id', 'default')
         
-        # Call the async endpoint internally
+        # Call the async endpoint internally (errors come back as (response, status))
         response = start_fetch_history()
+        if isinstance(response, tuple):
+            return response
         response_data = response.get_json()
         
         if not response_data.get('success', False):
@@ -715,43 +927,34 @@ def fetch_history():
         job_id = response_data.get('job_id')
         logger.info(f"Waiting for async job {job_id} to complete")
         
-        # Wait for the job to complete (with timeout)
-        start_time = time.time()
+        # Wait for the job to complete (with timeout) - the job thread sets
+        # the event when it finishes, so there's no polling of S3
         max_wait_time = 300  # 5 minutes max wait
+        job = email_fetch_jobs[job_id]
         
-        while time.time() - start_time < max_wait_time:
-            # Check job status
-            job_status_file = f"jobs/{job_id}/status.json"
+        if job['done'].wait(timeout=max_wait_time):
+            job_info = job['info']
+            status = job_info.get('status')
             
-            if file_exists(user_id, job_status_file):
-                job_info_content = read_file(user_id, job_status_file)
-                job_info = json.loads(job_info_content)
-                
-                status = job_info.get('status')
-                
-                if status == 'completed':
-                    logger.info(f"Job {job_id} completed successfully")
-                    # Return success with job details
-                    progress = job_info.get('progress', {})
-                    return jsonify({
-                        "success": True,
-                        "message": "Email history fetched successfully",
-                        "job_id": job_id,
-                        "output_file": "sent_emails.txt",
-                        "emails_processed": progress.get('total_fetched', 0),
-                        "emails_with_content": progress.get('processed', 0),
-                        "limit_reached": progress.get('limit_reached', False)
-                    })
-                
-                if status == 'failed':
-                    logger.info(f"Job {job_id} failed")
-                    return jsonify({
-                        "success": False,
-                        "message": job_info.get('error', 'Unknown error occurred')
-                    }), 400
+            if status == 'completed':
+                logger.info(f"Job {job_id} completed successfully")
+                # Return success with job details
+                progress = job_info.get('progress', {})
+                return jsonify({
+                    "success": True,
+                    "message": "Email history fetched successfully",
+                    "job_id": job_id,
+                    "output_file": SENT_EMAILS_FILE,
+                    "emails_processed": progress.get('total_fetched', 0),
+                    "emails_with_content": progress.get('processed', 0),
+                    "limit_reached": progress.get('limit_reached', False)
+                })
             
-            # Sleep for a bit before checking again
-            time.sleep(2)
+            logger.info(f"Job {job_id} failed")
+            return jsonify({
+                "success": False,
+                "message": job_info.get('error', 'Unknown error occurred')
+            }), 400
         
         # If we get here, the job is taking too long
         logger.warning(f"Job {job_id} is taking too long - returning job ID to client")
@@ -775,8 +978,8 @@ def analyze_voice():
         logger.info(f"Analyze voice endpoint accessed for user_id: {user_id}")
         
         # Set file paths - Currently using local filesystem
-        input_file = "sent_emails.txt"
-        output_file = "filtered_voice_emails.txt"
+        input_file = SENT_EMAILS_FILE
+        output_file = VOICE_EXAMPLES_FILE
         
         # Check if input file exists in S3 instead of local
         if not file_exists(user_id, input_file):
@@ -786,41 +989,57 @@ def analyze_voice():
                 "message": f"Input file not found: {input_file}. Please run fetch-history first."
             }), 400
         
-        # Setup findvoice arguments
-        old_argv = sys.argv.copy()
-        
         # Get model from request
         model = data.get('model', 'gpt-4o')
         logger.info(f"Using model: {model} for voice analysis")
         
-        # Configure arguments for findvoice.main() - Update to use user_id for S3
-        sys.argv = [
-            'findvoice.py',
-            '--user-id', user_id,  # Add user_id parameter
-            '--input', input_file,  # Change to just the filename
-            '--output', output_file,
-            '--model', model,
-            '--optimize'  # Enable optimization for better results
-        ]
+        # Configure arguments for findvoice.run_analysis()
+        analysis_args = {
+            'user_id': user_id,
+            'model': model,
+            'optimize': True  # Enable optimization for better results
+        }
         
         # Add optional parameters if provided
         if data.get('chunk_size'):
-            chunk_size = data.get('chunk_size')
-            sys.argv.extend(['--chunk-size', str(chunk_size)])
+            chunk_size = int(data.get('chunk_size'))
+            analysis_args['chunk_size'] = chunk_size
             logger.info(f"Using custom chunk size: {chunk_size}")
         
         if data.get('target_tokens'):
-            target_tokens = data.get('target_tokens')
-            sys.argv.extend(['--target-tokens', str(target_tokens)])
+            target_tokens = int(data.get('target_tokens'))
+            analysis_args['target_tokens'] = target_tokens
             logger.info(f"Using custom target tokens: {target_tokens}")
         
-        logger.info(f"Running voice analysis with args: {sys.argv}")
-        
-        # Run the findvoice main function
-        result = asyncio.run(findvoice.main())
+        logger.info(f"Running voice analysis with args: {analysis_args}")
+        
+        # Run in the background and let the client poll /api/job-status if asked to
+        if data.get('async'):
+            job_id = str(uuid.uuid4())
+            job_info = {
+                'job_id': job_id,
+                'user_id': user_id,
+                'type': 'analyze-voice',
+                'status': 'running',
+                'params': {'model': model},
+                'start_time': time.time(),
+                'last_updated': time.time()
+            }
+            write_file(user_id, f"jobs/{job_id}/status.json", orjson.dumps(job_info).decode('utf-8'))
+            asyncio.run_coroutine_threadsafe(
+                analyze_voice_job(job_id, user_id, input_file, output_file, analysis_args),
+                event_loop
+            )
+            logger.info(f"Started voice analysis job_id: {job_id} for user_id: {user_id}")
+            return jsonify({
+                "success": True,
+                "message": "Voice analysis job started",
+                "job_id": job_id,
+                "async": True
+            }), 202
         
-        # Restore original argv
-        sys.argv = old_argv
+        # Run the voice analysis on the shared event loop
+        result = run_coroutine(findvoice.run_analysis(input_file, output_file, **analysis_args))
         
         if result != 0:
             logger.error(f"Voice analysis failed with error code {result}")
@@ -839,6 +1058,43 @@ def analyze_voice():
         logger.error(f"Error in analyze_voice: {str(e)}", exc_info=True)
         return jsonify({"success": False, "message": str(e)}), 400
 
+async def analyze_voice_job(job_id, user_id, input_file, output_file, analysis_args):
+    """Run a voice analysis on the event loop and record the outcome in the job status."""
+    try:
+        result = await findvoice.run_analysis(input_file, output_file, **analysis_args)
+    except Exception as e:
+        logger.error(f"Error in voice analysis job {job_id}: {str(e)}", exc_info=True)
+        await asyncio.to_thread(update_job_status, job_id, user_id, "failed", error=str(e))
+        return
+    
+    if result != 0:
+        logger.error(f"Voice analysis job {job_id} failed with error code {result}")
+        await asyncio.to_thread(update_job_status, job_id, user_id, "failed",
+                                error=f"Voice analysis failed with error code {result}")
+    else:
+        logger.info(f"Voice analysis job {job_id} completed for user_id: {user_id}")
+        await asyncio.to_thread(update_job_status, job_id, user_id, "completed")
+
+@app.route('/api/job-status', methods=['GET'])
+def job_status():
+    """Check the status of any background job (email fetch or voice analysis)."""
+    job_id = request.args.get('job_id')
+    user_id = request.args.get('user_id', 'default')
+    
+    if not job_id:
+        return jsonify({"success": False, "message": "No job_id provided"}), 400
+    
+    try:
+        job_info = orjson.loads(read_file(user_id, f"jobs/{job_id}/status.json"))
+    except FileNotFoundError:
+        return jsonify({"success": False, "message": f"Job not found with ID: {job_id}"}), 404
+    except Exception as e:
+        logger.error(f"Error checking job status: {str(e)}", exc_info=True)
+        return jsonify({"success": False, "message": str(e)}), 400
+    
+    # The envelope's success comes last so a job's own fields can't override it
+    return jsonify({**job_info, "success": True})
+
 @app.route('/api/generate-content', methods=['POST'])
 def generate_content():
     """Generate content matching the user's writing style"""
@@ -859,21 +1115,55 @@ def generate_content():
         # Get the user context if provided
         context = data.get('context', {})
         if context:
-            logger.info(f"User context provided: {json.dumps(context)[:100]}...")
+            logger.info(f"User context provided: {orjson.dumps(context).decode()[:100]}...")
         
         # Use S3 filename instead of local path
-        examples_file = "filtered_voice_emails.txt"
+        examples_file = VOICE_EXAMPLES_FILE
         
-        # Check if examples file exists in S3
-        if not file_exists(user_id, examples_file):
+        # Check if examples file exists in S3 (its ETag also versions the cache key)
+        examples_etag = get_file_etag(user_id, examples_file)
+        if examples_etag is None:
             logger.error(f"Examples file not found for user_id: {user_id}")
             return jsonify({
                 "success": False,
                 "message": f"Examples file not found: {examples_file}. Please run analyze-voice first."
             }), 400
         
+        # Stream the text back as Server-Sent Events if the client asked for it
+        if data.get('stream'):
+            logger.info("Streaming generated content to client")
+            stream_args = {
+                'user_id': user_id,
+                'examples_file': examples_file,
+                'model': model,
+                'max_tokens': 2000,
+                'length': length,
+                'user_context': context,
+                'examples_etag': examples_etag
+            }
+            if prompt:
+                stream_args.update(free_form_prompt=prompt, temperature=0)
+            else:
+                stream_args.update(genre=genre, topic=topic, tone=tone, recipient=recipient)
+            return Response(
+                stream_with_context(stream_generated_content(stream_args)),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+        
         # Call the generate function with S3 access
         if prompt:
+            # Free-form prompts run at temperature 0, so identical requests
+            # against the same examples can be answered from the cache
+            cache_key = generated_cache_key(user_id, examples_etag, model, prompt, length, context)
+            generated_text = get_cached_generation(cache_key)
+            if generated_text is not None:
+                logger.info(f"Returning cached generated content ({len(generated_text)} characters)")
+                return jsonify({
+                    "success": True,
+                    "generated_text": generated_text
+                })
+            
             # Use free-form prompt mode when prompt is provided
             logger.info(f"Using free-form prompt: {prompt[:50]}...")
             generated_text = generate.generate_matching_text(
@@ -884,8 +1174,10 @@ def generate_content():
                 length=length,
                 free_form_prompt=prompt,
                 temperature=0,  # Low temperature for more predictable results
-                user_context=context  # Pass the user context
+                user_context=context,  # Pass the user context
+                examples_etag=examples_etag  # Already checked above; saves a second HEAD
             )
+            cache_generation(cache_key, generated_text)
         else:
             # Fallback to structured parameters if no prompt provided
             logger.info(f"Using structured parameters for generation")
@@ -899,7 +1191,8 @@ def generate_content():
                 tone=tone,
                 recipient=recipient,
                 length=length,
-                user_context=context  # Pass the user context
+                user_context=context,  # Pass the user context
+                examples_etag=examples_etag  # Already checked above; saves a second HEAD
             )
         
         logger.info(f"Content generation successful, generated {len(generated_text)} characters")
@@ -911,6 +1204,19 @@ def generate_content():
         logger.error(f"Error in generate_content: {str(e)}", exc_info=True)
         return jsonify({"success": False, "message": str(e)}), 400
 
+def stream_generated_content(stream_args):
+    """Yield generated text as Server-Sent Events, ending with a done or error event."""
+    total_length = 0
+    try:
+        for text in generate.stream_matching_text(**stream_args):
+            total_length += len(text)
+            yield b"data: " + orjson.dumps({"text": text}) + b"\n\n"
+        logger.info(f"Content generation stream complete, generated {total_length} characters")
+        yield b"data: " + orjson.dumps({"done": True}) + b"\n\n"
+    except Exception as e:
+        logger.error(f"Error streaming generated content: {str(e)}", exc_info=True)
+        yield b"data: " + orjson.dumps({"error": str(e)}) + b"\n\n"
+
 @app.route('/api/refine-content', methods=['POST'])
 def refine_content():
     """Refine previously generated content while maintaining the user's style"""
@@ -928,7 +1234,7 @@ def refine_content():
         # Get the user context if provided
         context = data.get('context', {})
         if context:
-            logger.info(f"User context provided: {json.dumps(context)[:100]}...")
+            logger.info(f"User context provided: {orjson.dumps(context).decode()[:100]}...")
         
         if not original_text:
             logger.error("Original text is required but not provided")
@@ -945,19 +1251,19 @@ def refine_content():
             }), 400
         
         # Use S3 filename instead of local path
-        examples_file = "filtered_voice_emails.txt"
+        examples_file = VOICE_EXAMPLES_FILE
         
-        # Check if examples file exists in S3
-        if not file_exists(user_id, examples_file):
+        # Check if examples file exists in S3 (a HEAD request; its ETag versions the cache)
+        examples_etag = get_file_etag(user_id, examples_file)
+        if examples_etag is None:
             logger.error(f"Examples file not found for user_id: {user_id}")
             return jsonify({
                 "success": False,
                 "message": f"Examples file not found: {examples_file}. Please run analyze-voice first."
             }), 400
         
-        # Read examples from S3
-        logger.info(f"Reading voice examples from S3 for user_id: {user_id}")
-        examples = read_file(user_id, examples_file)
+        # Examples are only read from S3 when the file has changed since the last request
+        examples = generate.load_examples_version(user_id, examples_file, model, examples_etag)
         
         # Call the refinement function with context
         logger.info("Calling refinement function")
@@ -983,7 +1289,8 @@ if __name__ == "__main__":
     # Get host and port from environment variables with defaults
     host = os.environ.get('HOST', '0.0.0.0')  # Listen on all interfaces by default
     port = int(os.environ.get('PORT', 8080))
-    debug = True
+    debug = os.environ.get('FLASK_ENV') == 'development'
     
-    print(f"Starting Flask server on {host}:{port} (debug={debug})...")
+    # Development server only - production runs under gunicorn (see gunicorn.conf.py)
+    print(f"Starting Flask development server on {host}:{port} (debug={debug})...")
     app.run(host=host, port=port, debug=debug) 
\ No newline at end of file
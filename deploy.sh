@@ -7,11 +7,14 @@ ZIP_FILE="mailsense-deployment.zip"
 rm -f $ZIP_FILE
 
 # Create a new zip file with explicitly selected files
-zip $ZIP_FILE .dockerignore .ebignore .gitignore app.py Dockerfile findvoice.py generate.py gmail_history.py requirements.txt
+zip $ZIP_FILE .dockerignore .ebignore .gitignore app.py wsgi.py gunicorn.conf.py Dockerfile findvoice.py generate.py gmail_history.py requirements.txt
 
 # Add .ebextensions folder
 zip -r $ZIP_FILE .ebextensions/
 
+# Add static pages served by the app
+zip -r $ZIP_FILE static/
+
 # Add only the mailsense package without unwanted files
 zip -r $ZIP_FILE mailsense/ -x "*.pyc" "*__pycache__*" "*.DS_Store"
 
@@ -12,15 +12,21 @@ import re
 import argparse
 import asyncio
 import time
+import logging
 import ssl
 from typing import List, Dict, Any, Tuple
 import tiktoken
 import json
 from dotenv import load_dotenv
 import concurrent.futures
+import functools
+import weakref
 from openai import OpenAI, AsyncOpenAI
 from openai.types.chat import ChatCompletionMessage
-from mailsense.storage import read_file, write_file, append_to_file, file_exists
+from mailsense.storage import read_file, write_file, append_to_file
+from mailsense.pool import get_process_pool
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file (including OPENAI_API_KEY)
 load_dotenv()
@@ -36,6 +42,13 @@ DEFAULT_CHUNK_SIZE = 8192  # tokens per chunk
 DEFAULT_OVERLAP = 200      # token overlap between chunks
 DEFAULT_MAX_TOKENS = 4096  # max tokens for completion
 
+# One record of the sent_emails.txt corpus, as written by gmail_history.format_email_entry
+EMAIL_RECORD_RE = re.compile(r"(Email ID: [^\n]+\nDate: [^\n]+\nTo: [^\n]+\nSubject: [^\n]+\nYour Content:[\s\S]+?={80})")
+
+# One AsyncOpenAI client per event loop, so chunks and requests share its
+# connection pool instead of opening new TLS connections each time
+_async_clients = weakref.WeakKeyDictionary()
+
 # Filter prompt template - refactored with forensic linguistic focus
 FILTER_PROMPT = """
 You are a forensic linguistic analyst extracting authentic voice patterns from an email corpus. Your task requires exceptionally precise discrimination between content that carries strong idiolectal signals and content that lacks distinctive linguistic markers.
@@ -153,8 +166,9 @@ INPUT CONTENT:
 {filtered_content}
 """
 
+@functools.lru_cache(maxsize=None)
 def get_encoder(model: str) -> tiktoken.Encoding:
-    """Get the appropriate tokenizer for the specified model."""
+    """Get the appropriate tokenizer for the specified model (cached per model)."""
     try:
         encoding = tiktoken.encoding_for_model(model)
     except KeyError:
@@ -171,15 +185,16 @@ def split_into_chunks(text: str, chunk_size: int, overlap: int, model: str) -> L
     encoder = get_encoder(model)
     
     # Extract email boundaries for smart chunking
-    email_pattern = r"(Email ID: [^\n]+\nDate: [^\n]+\nTo: [^\n]+\nSubject: [^\n]+\nYour Content:[\s\S]+?={80})"
-    emails = re.findall(email_pattern, text)
+    emails = EMAIL_RECORD_RE.findall(text)
     
     chunks = []
     current_chunk = ""
     current_tokens = 0
     
-    for email in emails:
-        email_tokens = len(encoder.encode(email))
+    # Tokenize all emails in one call; tiktoken spreads the batch across threads
+    email_token_counts = [len(tokens) for tokens in encoder.encode_batch(emails)]
+    
+    for email, email_tokens in zip(emails, email_token_counts):
         
         # If this email alone exceeds chunk size, we need to split it
         if email_tokens > chunk_size:
@@ -207,13 +222,26 @@ def split_into_chunks(text: str, chunk_size: int, overlap: int, model: str) -> L
     
     return chunks
 
+def tokenize_and_split(text: str, chunk_size: int, overlap: int, model: str) -> Tuple[int, List[str]]:
+    """Count the input tokens and split the text into chunks. Returns (token_count, chunks)."""
+    return count_tokens(text, model), split_into_chunks(text, chunk_size, overlap, model)
+
+def get_async_client() -> AsyncOpenAI:
+    """Get the AsyncOpenAI client for the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+        _async_clients[loop] = client
+    return client
+
 async def process_chunk(chunk: str, model: str, max_tokens: int, chunk_number: int, 
                         total_chunks: int, user_id: str, output_file: str, file_lock) -> int:
     """Process a text chunk through the OpenAI API and write results to S3 immediately."""
     prompt = FILTER_PROMPT.format(chunk=chunk)
     
-    # Create AsyncOpenAI client
-    client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    # Shared AsyncOpenAI client for this event loop
+    client = get_async_client()
     
     # Implement retry logic with increased retries for SSL errors
     max_retries = 5  # Increased from 3 to 5
@@ -221,7 +249,7 @@ async def process_chunk(chunk: str, model: str, max_tokens: int, chunk_number: i
     
     for attempt in range(max_retries):
         try:
-            print(f"Processing chunk {chunk_number}/{total_chunks}...")
+            logger.info(f"Processing chunk {chunk_number}/{total_chunks}...")
             
             # Use the official OpenAI client to make the API call
             response = await client.chat.completions.create(
@@ -236,33 +264,33 @@ async def process_chunk(chunk: str, model: str, max_tokens: int, chunk_number: i
             
             filtered_content = response.choices[0].message.content
             
-            # Write to S3 instead of local file
+            # Write to S3 instead of local file (off the event loop so other chunks keep running)
             async with file_lock:
-                append_to_file(user_id, output_file, filtered_content + "\n\n")
+                await asyncio.to_thread(append_to_file, user_id, output_file, filtered_content + "\n\n")
             
             output_tokens = count_tokens(filtered_content, model)
-            print(f"✓ Processed chunk {chunk_number}/{total_chunks} - Tokens: {output_tokens}")
+            logger.info(f"✓ Processed chunk {chunk_number}/{total_chunks} - Tokens: {output_tokens}")
             return output_tokens
             
         except ssl.SSLError as e:
             # Special handling for SSL errors
             retry_delay = base_retry_delay * (attempt + 1) * 2  # Longer delay for SSL errors
-            print(f"SSL Error processing chunk {chunk_number}: {str(e)}")
-            print(f"This is likely a temporary network issue. Retrying in {retry_delay} seconds...")
+            logger.error(f"SSL Error processing chunk {chunk_number}: {str(e)}")
+            logger.warning(f"This is likely a temporary network issue. Retrying in {retry_delay} seconds...")
             await asyncio.sleep(retry_delay)
         except Exception as e:
             # General exception handling
             retry_delay = base_retry_delay * (attempt + 1)
-            print(f"Error processing chunk {chunk_number}: {str(e)}")
-            print(f"Retrying in {retry_delay} seconds...")
+            logger.error(f"Error processing chunk {chunk_number}: {str(e)}")
+            logger.warning(f"Retrying in {retry_delay} seconds...")
             await asyncio.sleep(retry_delay)
     
-    print(f"Failed to process chunk {chunk_number} after {max_retries} attempts")
+    logger.error(f"Failed to process chunk {chunk_number} after {max_retries} attempts")
     
     # Write a failure notice to the output file
     error_message = f"[Processing failed for chunk {chunk_number}]"
     async with file_lock:
-        append_to_file(user_id, output_file, error_message + "\n\n")
+        await asyncio.to_thread(append_to_file, user_id, output_file, error_message + "\n\n")
     
     return 0  # Return 0 tokens for a failed chunk
 
@@ -270,10 +298,10 @@ async def apply_second_stage_filter(content: str, model: str, max_tokens: int, t
     """Apply a second-stage filter to further reduce content to under target_tokens."""
     content_tokens = count_tokens(content, model)
     if content_tokens <= target_tokens:
-        print(f"Content already under {target_tokens} tokens, skipping second-stage filter")
+        logger.info(f"Content already under {target_tokens} tokens, skipping second-stage filter")
         return content
     
-    print(f"Applying second-stage filter to reduce content from {content_tokens} tokens to under {target_tokens} tokens...")
+    logger.info(f"Applying second-stage filter to reduce content from {content_tokens} tokens to under {target_tokens} tokens...")
     
     # If content is too large for context window, we need to chunk it again
     model_max_tokens = 120000  # Conservative estimate for model's max context length
@@ -281,15 +309,14 @@ async def apply_second_stage_filter(content: str, model: str, max_tokens: int, t
     available_tokens = model_max_tokens - prompt_template_tokens - 1000  # Extra buffer
     
     if content_tokens > available_tokens:
-        print(f"Content too large ({content_tokens} tokens) for second-stage filtering in one pass")
-        print(f"Splitting into smaller chunks for incremental processing...")
+        logger.warning(f"Content too large ({content_tokens} tokens) for second-stage filtering in one pass")
+        logger.info(f"Splitting into smaller chunks for incremental processing...")
         
         # Extract individual emails from the content
-        email_pattern = r"(Email ID: [^\n]+\nDate: [^\n]+\nTo: [^\n]+\nSubject: [^\n]+\nYour Content:[\s\S]+?={80})"
-        emails = re.findall(email_pattern, content)
+        emails = EMAIL_RECORD_RE.findall(content)
         
         if not emails:
-            print("Warning: Couldn't identify individual emails in the content. Using basic chunking.")
+            logger.warning("Warning: Couldn't identify individual emails in the content. Using basic chunking.")
             # If we can't identify emails, use simple chunking by tokens
             encoder = get_encoder(model)
             tokens = encoder.encode(content)
@@ -300,14 +327,14 @@ async def apply_second_stage_filter(content: str, model: str, max_tokens: int, t
                 chunk_tokens = tokens[i:i + chunk_size]
                 chunks.append(encoder.decode(chunk_tokens))
         else:
-            print(f"Identified {len(emails)} individual emails for incremental processing")
+            logger.info(f"Identified {len(emails)} individual emails for incremental processing")
             chunks = [emails[i:i+50] for i in range(0, len(emails), 50)]
             chunks = ["\n\n".join(chunk_emails) for chunk_emails in chunks]
         
         # Process each chunk with the second stage filter and combine results
         combined_result = ""
         for i, chunk in enumerate(chunks):
-            print(f"Processing chunk {i+1}/{len(chunks)} for second-stage filtering...")
+            logger.info(f"Processing chunk {i+1}/{len(chunks)} for second-stage filtering...")
             # Calculate proportional token target for this chunk
             proportional_target = max(int(target_tokens/len(chunks)), 1000)
             chunk_result = await process_single_second_stage_chunk(chunk, model, max_tokens, proportional_target)
@@ -315,23 +342,23 @@ async def apply_second_stage_filter(content: str, model: str, max_tokens: int, t
             
             # Monitor total tokens
             current_tokens = count_tokens(combined_result, model)
-            print(f"Current total tokens after chunk {i+1}: {current_tokens}/{target_tokens}")
+            logger.info(f"Current total tokens after chunk {i+1}: {current_tokens}/{target_tokens}")
             
             # Stop if we've reached or exceeded target
             if current_tokens >= target_tokens:
-                print(f"Reached target token count, stopping incremental processing")
+                logger.info(f"Reached target token count, stopping incremental processing")
                 break
         
         # Final pass to ensure we meet target token count
         final_tokens = count_tokens(combined_result, model)
         if final_tokens > target_tokens:
-            print(f"Final result ({final_tokens} tokens) exceeds target ({target_tokens}). Running final optimization pass...")
+            logger.warning(f"Final result ({final_tokens} tokens) exceeds target ({target_tokens}). Running final optimization pass...")
             # If still over target, do one final filtering pass on the combined result
             if final_tokens < available_tokens:
                 combined_result = await process_single_second_stage_chunk(combined_result, model, max_tokens, target_tokens)
             else:
                 # If too large, truncate to roughly target tokens
-                print("Content still too large for final pass, truncating to target token count...")
+                logger.warning("Content still too large for final pass, truncating to target token count...")
                 encoder = get_encoder(model)
                 tokens = encoder.encode(combined_result)
                 combined_result = encoder.decode(tokens[:target_tokens])
@@ -346,8 +373,8 @@ async def process_single_second_stage_chunk(content: str, model: str, max_tokens
     # Update the prompt to specify the target token count for this chunk
     prompt = SECOND_STAGE_PROMPT.format(filtered_content=content)
     
-    # Create AsyncOpenAI client
-    client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    # Shared AsyncOpenAI client for this event loop
+    client = get_async_client()
     
     max_retries = 5
     base_retry_delay = 5  # seconds
@@ -367,25 +394,40 @@ async def process_single_second_stage_chunk(content: str, model: str, max_tokens
             optimized_content = response.choices[0].message.content
             token_count = count_tokens(optimized_content, model)
             
-            print(f"Second-stage filtering complete for chunk. Tokens: {token_count}/{target_tokens}")
+            logger.info(f"Second-stage filtering complete for chunk. Tokens: {token_count}/{target_tokens}")
             
             return optimized_content
             
         except Exception as e:
             retry_delay = base_retry_delay * (attempt + 1)
-            print(f"Error in second-stage filtering: {str(e)}")
-            print(f"Retrying in {retry_delay} seconds...")
+            logger.error(f"Error in second-stage filtering: {str(e)}")
+            logger.warning(f"Retrying in {retry_delay} seconds...")
             await asyncio.sleep(retry_delay)
     
-    print(f"Failed to apply second-stage filter after {max_retries} attempts")
+    logger.error(f"Failed to apply second-stage filter after {max_retries} attempts")
     return ""  # Return empty string if filtering fails completely
 
+def read_local_file(path: str) -> str:
+    """Read a local text file (blocking; call via asyncio.to_thread)."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def write_local_file(path: str, content: str) -> None:
+    """Write a local text file in one write (blocking; call via asyncio.to_thread)."""
+    data = content.encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(data)
+        # Nothing in the server reads these files back, so don't keep them in page cache
+        if hasattr(os, 'posix_fadvise'):
+            f.flush()
+            os.posix_fadvise(f.fileno(), 0, len(data), os.POSIX_FADV_DONTNEED)
+
 async def process_chunks_parallel(chunks: List[str], model: str, max_tokens: int, output_file: str, 
-                                 apply_second_filter: bool = False, user_id: str = "default") -> int:
+                                 apply_second_filter: bool = False, user_id: str = "default",
+                                 target_tokens: int = 4000) -> int:
     """Process all chunks in parallel with rate limiting and write to file as they complete."""
     # Initialize output file with empty content
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write("")  # Create or clear the file
+    await asyncio.to_thread(write_local_file, output_file, "")  # Create or clear the file
     
     # Create a lock for file access
     file_lock = asyncio.Lock()
@@ -398,39 +440,86 @@ async def process_chunks_parallel(chunks: List[str], model: str, max_tokens: int
         tasks.append(process_chunk(chunk, model, max_tokens, i+1, len(chunks), user_id, output_file, file_lock))
     
     # Start all requests simultaneously but with slight staggering
-    print(f"Starting parallel processing of {len(chunks)} chunks...")
+    logger.info(f"Starting parallel processing of {len(chunks)} chunks...")
     
     # Process all chunks and wait for them to complete
     output_tokens = await asyncio.gather(*tasks, return_exceptions=False)
     
     # Return the total number of output tokens from first-stage filtering
     first_stage_tokens = sum(token_count for token_count in output_tokens if isinstance(token_count, int))
-    print(f"First-stage filtering complete. Total tokens: {first_stage_tokens}")
+    logger.info(f"First-stage filtering complete. Total tokens: {first_stage_tokens}")
     
     # Apply second-stage filtering if requested
     if apply_second_filter:
         # Read the first-stage output
-        with open(output_file, 'r', encoding='utf-8') as f:
-            first_stage_content = f.read()
+        first_stage_content = await asyncio.to_thread(read_local_file, output_file)
         
-        print(f"Applying second-stage filter to first-stage output ({first_stage_tokens} tokens)...")
+        logger.info(f"Applying second-stage filter to first-stage output ({first_stage_tokens} tokens)...")
         
         # Apply second-stage filter
-        optimized_content = await apply_second_stage_filter(first_stage_content, model, max_tokens)
+        optimized_content = await apply_second_stage_filter(first_stage_content, model, max_tokens, target_tokens)
         optimized_tokens = count_tokens(optimized_content, model)
         
         # Save the optimized content to a new file
         optimized_file = output_file.replace('.txt', '_optimized.txt')
-        with open(optimized_file, 'w', encoding='utf-8') as f:
-            f.write(optimized_content)
+        await asyncio.to_thread(write_local_file, optimized_file, optimized_content)
         
-        print(f"Optimized content saved to: {optimized_file} ({optimized_tokens} tokens)")
+        logger.info(f"Optimized content saved to: {optimized_file} ({optimized_tokens} tokens)")
         
         # Return the token count of the second-stage output
         return optimized_tokens
     
     return first_stage_tokens
 
+async def run_analysis(input_file: str, output_file: str = "filtered_voice_emails.txt",
+                       model: str = DEFAULT_MODEL, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                       overlap: int = DEFAULT_OVERLAP, max_tokens: int = DEFAULT_MAX_TOKENS,
+                       skip_to: int = 0, optimize: bool = False, target_tokens: int = 4000,
+                       user_id: str = "default") -> int:
+    """Filter a user's email corpus down to authentic voice content. Returns 0 on success."""
+    # Read the input file from S3
+    logger.info(f"Reading input file: {input_file} for user {user_id}")
+    try:
+        text = await asyncio.to_thread(read_file, user_id, input_file)
+    except FileNotFoundError:
+        logger.error(f"Error: Input file '{input_file}' not found for user {user_id}.")
+        return 1
+    
+    # Count tokens and split into chunks in a worker process, so the CPU-bound
+    # tokenization doesn't block the event loop (or the GIL) for other requests
+    logger.info(f"Splitting text into chunks of {chunk_size} tokens with {overlap} token overlap")
+    loop = asyncio.get_running_loop()
+    token_count, chunks = await loop.run_in_executor(
+        get_process_pool(), tokenize_and_split, text, chunk_size, overlap, model)
+    logger.info(f"Total input tokens: {token_count}")
+    logger.info(f"Created {len(chunks)} chunks")
+    
+    # Handle skip-to option
+    if skip_to > 0 and skip_to <= len(chunks):
+        logger.info(f"Skipping to chunk {skip_to}/{len(chunks)}")
+        chunks = chunks[skip_to-1:]
+    
+    # Process chunks in parallel and write to file as they complete
+    start_time = time.time()
+    logger.info(f"Processing chunks with {model} in parallel...")
+    output_token_count = await process_chunks_parallel(
+        chunks, model, max_tokens, output_file, optimize, user_id, target_tokens)
+    
+    elapsed_time = time.time() - start_time
+    logger.info(f"Processing completed in {elapsed_time:.2f} seconds")
+    
+    if optimize:
+        logger.info(f"Final optimized content saved to: {output_file.replace('.txt', '_optimized.txt')}")
+    else:
+        logger.info(f"Filtered content saved to: {output_file}")
+    
+    # Calculate token counts and reduction
+    reduction = 100 - (output_token_count / token_count * 100)
+    logger.info(f"Input tokens: {token_count}, Output tokens: {output_token_count}")
+    logger.info(f"Reduced content by {reduction:.2f}%")
+    
+    return 0
+
 async def main():
     """Main function to run the script."""
     parser = argparse.ArgumentParser(description="Process email corpus to extract authentic voice")
@@ -456,49 +545,19 @@ async def main():
     
     args = parser.parse_args()
     
-    # Verify input file exists in S3
-    if not file_exists(args.user_id, args.input):
-        print(f"Error: Input file '{args.input}' not found for user {args.user_id}.")
-        return 1
-    
-    # Read the input file from S3
-    print(f"Reading input file: {args.input} for user {args.user_id}")
-    text = read_file(args.user_id, args.input)
-    
-    # Calculate token count
-    token_count = count_tokens(text, args.model)
-    print(f"Total input tokens: {token_count}")
-    
-    # Split into chunks
-    print(f"Splitting text into chunks of {args.chunk_size} tokens with {args.overlap} token overlap")
-    chunks = split_into_chunks(text, args.chunk_size, args.overlap, args.model)
-    print(f"Created {len(chunks)} chunks")
-    
-    # Handle skip-to option
-    if args.skip_to > 0 and args.skip_to <= len(chunks):
-        print(f"Skipping to chunk {args.skip_to}/{len(chunks)}")
-        chunks = chunks[args.skip_to-1:]
-    
-    # Process chunks in parallel and write to file as they complete
-    start_time = time.time()
-    print(f"Processing chunks with {args.model} in parallel...")
-    output_token_count = await process_chunks_parallel(
-        chunks, args.model, args.max_tokens, args.output, args.optimize, args.user_id)
-    
-    elapsed_time = time.time() - start_time
-    print(f"Processing completed in {elapsed_time:.2f} seconds")
-    
-    if args.optimize:
-        print(f"Final optimized content saved to: {args.output.replace('.txt', '_optimized.txt')}")
-    else:
-        print(f"Filtered content saved to: {args.output}")
-    
-    # Calculate token counts and reduction
-    reduction = 100 - (output_token_count / token_count * 100)
-    print(f"Input tokens: {token_count}, Output tokens: {output_token_count}")
-    print(f"Reduced content by {reduction:.2f}%")
-    
-    return 0
+    return await run_analysis(
+        args.input,
+        args.output,
+        model=args.model,
+        chunk_size=args.chunk_size,
+        overlap=args.overlap,
+        max_tokens=args.max_tokens,
+        skip_to=args.skip_to,
+        optimize=args.optimize,
+        target_tokens=args.target_tokens,
+        user_id=args.user_id
+    )
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     asyncio.run(main())
\ No newline at end of file
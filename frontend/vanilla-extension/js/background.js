@@ -83,7 +83,8 @@ async function startAuthProcess(userId) {
     const response = await fetch(`${API_URL}/authenticate`, {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ user_id: userId })
+      // The extension closes the auth tab itself, so the server can skip its success page
+      body: JSON.stringify({ user_id: userId, client: 'extension' })
     });
     
     const data = await response.json();
@@ -127,6 +128,12 @@ async function startAuthProcess(userId) {
           });
         });
         
+        // Close the auth tab - the server answers the callback with an empty 204
+        if (extensionState.lastAuthTab) {
+          chrome.tabs.remove(extensionState.lastAuthTab, () => void chrome.runtime.lastError);
+          extensionState.lastAuthTab = null;
+        }
+        
         // Clear the interval
         clearInterval(authCheckIntervalIds[userId]);
         delete authCheckIntervalIds[userId];
@@ -10,11 +10,15 @@ higher-order linguistic effects.
 import os
 import argparse
 import time
+import functools
+import logging
 from typing import Dict, Any
 from dotenv import load_dotenv
 from openai import OpenAI
 import tiktoken
-from mailsense.storage import read_file, write_file, file_exists
+from mailsense.storage import read_file, write_file, file_exists, get_file_etag
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file (including OPENAI_API_KEY)
 load_dotenv()
@@ -317,7 +321,7 @@ def refine_generated_text(
     # Create OpenAI client
     client = OpenAI(api_key=OPENAI_API_KEY)
     
-    print(f"Refining text with {model}...")
+    logger.info(f"Refining text with {model}...")
     start_time = time.time()
     
     # Make the API call
@@ -334,54 +338,73 @@ def refine_generated_text(
     refined_text = response.choices[0].message.content
     
     elapsed_time = time.time() - start_time
-    print(f"Text refinement completed in {elapsed_time:.2f} seconds")
+    logger.info(f"Text refinement completed in {elapsed_time:.2f} seconds")
     
     return refined_text
 
-def generate_matching_text(
-    user_id: str,
-    examples_file: str,
-    model: str = DEFAULT_MODEL,
-    max_tokens: int = DEFAULT_MAX_TOKENS,
-    genre: str = None,
-    topic: str = None,
-    tone: str = None,
-    recipient: str = None,
-    length: int = 300,
-    temperature: float = 0.7,
-    output_file: str = None,
-    free_form_prompt: str = None,
-    refinement: str = None,
-    interactive: bool = False,
-    user_context=None
-) -> str:
-    """Generate text that forensically matches the author's writing style."""
+def load_examples(user_id: str, examples_file: str, model: str = DEFAULT_MODEL, etag: str = None) -> str:
+    """Get the user's examples, truncated to fit the model's context, from cache while the S3 file is unchanged.
     
-    # Ensure user_context is always a dict
-    if user_context is None:
-        user_context = {}
+    Pass the file's ETag if the caller already has it, to skip the HEAD request.
+    """
+    if etag is None:
+        try:
+            etag = get_file_etag(user_id, examples_file)
+        except Exception as e:
+            logger.error(f"Error reading examples file: {e}")
+            raise Exception(f"Failed to read examples file: {str(e)}")
+        
+        if etag is None:
+            raise Exception(f"Failed to read examples file: {examples_file} not found for user {user_id}")
     
+    return load_examples_version(user_id, examples_file, model, etag)
+
+@functools.lru_cache(maxsize=64)
+def load_examples_version(user_id: str, examples_file: str, model: str, etag: str) -> str:
+    """Read and truncate one version (ETag) of the examples file, cached per version."""
     # Read the examples file from S3
-    print(f"Reading examples from S3: {examples_file} for user {user_id}")
+    logger.info(f"Reading examples from S3: {examples_file} for user {user_id}")
     try:
         examples = read_file(user_id, examples_file)
     except Exception as e:
-        print(f"Error reading examples file: {e}")
+        logger.error(f"Error reading examples file: {e}")
         raise Exception(f"Failed to read examples file: {str(e)}")
     
     # Count tokens in examples to ensure we stay within context limits
-    examples_tokens = count_tokens(examples, model)
+    encoder = get_encoder(model)
+    tokens = encoder.encode(examples)
     max_example_tokens = 80000  # Conservative limit for most models
     
-    if examples_tokens > max_example_tokens:
-        print(f"Warning: Examples exceed {max_example_tokens} tokens ({examples_tokens})")
-        print(f"Truncating examples to fit within context window...")
+    if len(tokens) > max_example_tokens:
+        logger.warning(f"Warning: Examples exceed {max_example_tokens} tokens ({len(tokens)})")
+        logger.warning(f"Truncating examples to fit within context window...")
         
         # Truncate examples to fit within limits
-        encoder = get_encoder(model)
-        tokens = encoder.encode(examples)
         examples = encoder.decode(tokens[:max_example_tokens])
-        print(f"Truncated to {count_tokens(examples, model)} tokens")
+        logger.info(f"Truncated to {count_tokens(examples, model)} tokens")
+    
+    return examples
+
+def build_generation_prompt(
+    user_id: str,
+    examples_file: str,
+    model: str = DEFAULT_MODEL,
+    genre: str = None,
+    topic: str = None,
+    tone: str = None,
+    recipient: str = None,
+    length: int = 300,
+    free_form_prompt: str = None,
+    user_context=None,
+    examples_etag: str = None
+):
+    """Read the user's examples and build the generation prompt. Returns (examples, prompt)."""
+    
+    # Ensure user_context is always a dict
+    if user_context is None:
+        user_context = {}
+    
+    examples = load_examples(user_id, examples_file, model, examples_etag)
     
     # Format user prompt based on whether we're using free-form or structured
     if free_form_prompt:
@@ -451,10 +474,50 @@ IMPORTANT FORENSIC CONSIDERATIONS:
 7. The output should be indistinguishable from my authentic writing even to expert analysis
 """
 
+    return examples, prompt
+
+def generate_matching_text(
+    user_id: str,
+    examples_file: str,
+    model: str = DEFAULT_MODEL,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    genre: str = None,
+    topic: str = None,
+    tone: str = None,
+    recipient: str = None,
+    length: int = 300,
+    temperature: float = 0.7,
+    output_file: str = None,
+    free_form_prompt: str = None,
+    refinement: str = None,
+    interactive: bool = False,
+    user_context=None,
+    examples_etag: str = None
+) -> str:
+    """Generate text that forensically matches the author's writing style."""
+    
+    # Ensure user_context is always a dict
+    if user_context is None:
+        user_context = {}
+    
+    examples, prompt = build_generation_prompt(
+        user_id=user_id,
+        examples_file=examples_file,
+        model=model,
+        genre=genre,
+        topic=topic,
+        tone=tone,
+        recipient=recipient,
+        length=length,
+        free_form_prompt=free_form_prompt,
+        user_context=user_context,
+        examples_etag=examples_etag
+    )
+    
     # Create OpenAI client
     client = OpenAI(api_key=OPENAI_API_KEY)
     
-    print(f"Generating text with {model}...")
+    logger.info(f"Generating text with {model}...")
     start_time = time.time()
     
     # Make the API call
@@ -471,7 +534,7 @@ IMPORTANT FORENSIC CONSIDERATIONS:
     generated_text = response.choices[0].message.content
     
     elapsed_time = time.time() - start_time
-    print(f"Text generation completed in {elapsed_time:.2f} seconds")
+    logger.info(f"Text generation completed in {elapsed_time:.2f} seconds")
     
     # Handle refinement if requested
     if refinement or interactive:
@@ -525,10 +588,60 @@ IMPORTANT FORENSIC CONSIDERATIONS:
     # Save to S3 if output file specified
     if output_file:
         write_file(user_id, output_file, generated_text)
-        print(f"Generated text saved to S3: {output_file} for user {user_id}")
+        logger.info(f"Generated text saved to S3: {output_file} for user {user_id}")
     
     return generated_text
 
+def stream_matching_text(
+    user_id: str,
+    examples_file: str,
+    model: str = DEFAULT_MODEL,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    genre: str = None,
+    topic: str = None,
+    tone: str = None,
+    recipient: str = None,
+    length: int = 300,
+    temperature: float = 0.7,
+    free_form_prompt: str = None,
+    user_context=None,
+    examples_etag: str = None
+):
+    """Generate text in the author's style, yielding it piece by piece as the model produces it."""
+    examples, prompt = build_generation_prompt(
+        user_id=user_id,
+        examples_file=examples_file,
+        model=model,
+        genre=genre,
+        topic=topic,
+        tone=tone,
+        recipient=recipient,
+        length=length,
+        free_form_prompt=free_form_prompt,
+        user_context=user_context,
+        examples_etag=examples_etag
+    )
+    
+    # Create OpenAI client
+    client = OpenAI(api_key=OPENAI_API_KEY)
+    
+    logger.info(f"Streaming text generation with {model}...")
+    
+    stream = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=True
+    )
+    
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
 def main():
     """Main function to run the script."""
     parser = argparse.ArgumentParser(description="Generate text that forensically matches an author's writing style")
@@ -577,7 +690,7 @@ def main():
     
     # Verify examples file exists in S3
     if not file_exists(args.user_id, args.examples_file):
-        print(f"Error: Examples file '{args.examples_file}' not found for user {args.user_id}.")
+        logger.error(f"Error: Examples file '{args.examples_file}' not found for user {args.user_id}.")
         return 1
     
     # Generate text with S3 integration
@@ -609,4 +722,5 @@ def main():
     return 0
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     main()
@@ -1,4 +1,4 @@
-from mailsense.gmail import GmailClient
+from mailsense.gmail import GmailClient, MESSAGE_FIELDS, DATA_DIR
 import base64
 import time
 import re
@@ -6,7 +6,202 @@ import email
 import html
 import os
 import argparse
-from mailsense.storage import read_file, write_file, append_to_file, file_exists
+import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+from mailsense.storage import write_file, upload_file, download_file
+from mailsense.progress import ProgressStore
+from mailsense.pool import get_process_pool, PROCESS_POOL_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Line that terminates each email record in sent_emails.txt
+EMAIL_SEPARATOR = "=" * 80
+
+# Message fetch concurrency and quota settings. messages.get costs 5 quota
+# units and Gmail allows 250 units per second per user.
+FETCH_CONCURRENCY = int(os.environ.get('GMAIL_FETCH_CONCURRENCY', 8))
+FETCH_RATE_LIMIT = 50  # messages.get calls per second
+FETCH_BATCH_SIZE = 50  # Gmail recommends at most 50 calls per batch request
+FETCH_MAX_RETRIES = 3
+RETRYABLE_STATUSES = (429, 500, 503)
+
+# Extra Gmail search terms appended to the sent-mail query, e.g. '-filename:ics'
+# to skip calendar invites. Off by default: any term can also drop mail the user
+# wrote (an invite can carry a personal note), so it's up to the deployment
+SENT_QUERY_FILTERS = os.environ.get('GMAIL_QUERY_FILTERS', '')
+
+# Common patterns for quoted content start
+QUOTED_START_PATTERNS = [
+    r'^On .+ wrote:$',           # Standard Gmail quote format
+    r'^>.+',                     # Line starting with >
+    r'^From: ',                  # Quoted headers
+    r'^Date: ',
+    r'^Subject: ',
+    r'^To: ',
+    r'^Sent from ',              # Common mobile signatures
+    r'^-+Original Message-+',    # Forwarded message markers
+    r'^-+Forwarded message-+',
+    r'^_+',                      # Horizontal rule markers
+]
+
+# Signature markers - these typically end the user's content
+SIGNATURE_PATTERNS = [
+    r'^--\s*$',                  # Standard signature marker
+    r'^__+\s*$',                 # Underscores as signature marker
+    r'^-+\s*$',                  # Dashes as signature marker
+    r'^Regards,\s*$',            # Common signature starter
+    r'^Best,\s*$',               # Common signature starter
+    r'^Thanks,\s*$',             # Common signature starter
+    r'^Thank you,\s*$',          # Common signature starter
+    r'^Sincerely,\s*$',          # Common signature starter
+    r'^Cheers,\s*$',             # Common signature starter
+]
+
+# Each pattern list combined and compiled once
+QUOTE_START_RE = re.compile('|'.join(f'({p})' for p in QUOTED_START_PATTERNS))
+SIGNATURE_RE = re.compile('|'.join(f'({p})' for p in SIGNATURE_PATTERNS))
+
+# Automatic mobile/client signatures left at the very end of a message
+TRAILING_SIGNATURE_RES = (
+    re.compile(r'\n+Sent from my iPhone\s*$'),
+    re.compile(r'\n+Sent from my Android\s*$'),
+    re.compile(r'\n+Get Outlook for (iOS|Android)\s*$'),
+)
+
+# The ID line that starts each record of sent_emails.txt
+EMAIL_ID_RE = re.compile(r'^Email ID: (.+)$', re.MULTILINE)
+
+# Used by clean_html
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+WHITESPACE_RE = re.compile(r'\s+')
+
+class RateLimiter:
+    """Space out calls across threads so at most `rate` start per second."""
+    
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+    
+    def wait(self, calls=1):
+        """Block until the caller's slot for `calls` calls comes up."""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval * calls
+        if delay > 0:
+            time.sleep(delay)
+
+def is_retryable(error):
+    """Whether a Gmail API error is worth retrying (rate limiting / transient)."""
+    return isinstance(error, HttpError) and error.resp.status in RETRYABLE_STATUSES
+
+def backoff(attempt):
+    """Sleep before retry number `attempt`: exponential with jitter, capped at 32s."""
+    time.sleep(min(32, 2 ** attempt) + random.random())
+
+def execute_with_retry(request, max_retries=FETCH_MAX_RETRIES, **kwargs):
+    """Execute a Gmail API request, retrying with backoff on rate limiting / transient errors."""
+    for attempt in range(max_retries + 1):
+        try:
+            return request.execute(**kwargs)
+        except HttpError as e:
+            if not is_retryable(e) or attempt == max_retries:
+                raise
+            logger.warning(f"Gmail API returned {e.resp.status}, retrying (attempt {attempt + 1}/{max_retries})")
+            backoff(attempt)
+
+def fetch_messages(client, msg_ids, max_workers=FETCH_CONCURRENCY):
+    """Fetch full messages in batch requests, within Gmail's per-user rate limit.
+    
+    Up to FETCH_BATCH_SIZE messages.get calls go out in each HTTP request, and
+    batches run concurrently. Returns a list of (msg_id, message, error) tuples
+    in the order of msg_ids; exactly one of message and error is set for each entry.
+    """
+    if not msg_ids:
+        return []
+    
+    limiter = RateLimiter(FETCH_RATE_LIMIT)
+    results = [None] * len(msg_ids)
+    
+    def execute_batch(indexes, http):
+        pending = indexes
+        for attempt in range(FETCH_MAX_RETRIES + 1):
+            retry = []
+            
+            def callback(request_id, response, exception):
+                index = int(request_id)
+                if exception is None:
+                    results[index] = (msg_ids[index], response, None)
+                elif is_retryable(exception) and attempt < FETCH_MAX_RETRIES:
+                    retry.append(index)
+                else:
+                    results[index] = (msg_ids[index], None, exception)
+            
+            batch = client.service.new_batch_http_request(callback=callback)
+            for index in pending:
+                batch.add(
+                    client.service.users().messages().get(
+                        userId='me', id=msg_ids[index], format='full', fields=MESSAGE_FIELDS
+                    ),
+                    request_id=str(index)
+                )
+            
+            limiter.wait(len(pending))
+            try:
+                batch.execute(http=http)
+            except Exception as e:
+                # The batch request as a whole failed
+                if not is_retryable(e) or attempt == FETCH_MAX_RETRIES:
+                    for index in pending:
+                        results[index] = (msg_ids[index], None, e)
+                    return
+                retry = pending
+            
+            if not retry:
+                return
+            pending = retry
+            # Exponential backoff with jitter on rate limiting / transient errors
+            backoff(attempt)
+    
+    def run_batch(indexes):
+        # Connections are pooled on the client, so later groups reuse open sockets
+        http = client.acquire_http()
+        try:
+            execute_batch(indexes, http)
+        finally:
+            client.release_http(http)
+    
+    batches = [
+        list(range(start, min(start + FETCH_BATCH_SIZE, len(msg_ids))))
+        for start in range(0, len(msg_ids), FETCH_BATCH_SIZE)
+    ]
+    
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as pool:
+        for future in [pool.submit(run_batch, batch) for batch in batches]:
+            future.result()
+    
+    return results
+
+def list_messages_page(client, query, page_token=None):
+    """List one page of message IDs matching query, on a pooled connection.
+    
+    Runs alongside fetch_messages while the previous page is processed, so it
+    takes its own connection rather than the service's shared one.
+    """
+    http = client.acquire_http()
+    try:
+        return execute_with_retry(client.service.users().messages().list(
+            userId='me',
+            q=query,
+            maxResults=100,
+            pageToken=page_token
+        ), http=http)
+    finally:
+        client.release_http(http)
 
 def clean_html(html_content):
     """Remove HTML tags from content."""
@@ -14,8 +209,8 @@ def clean_html(html_content):
         return ""
     # Convert HTML entities and remove tags
     text = html.unescape(html_content)
-    text = re.sub(r'<[^>]+>', ' ', text)
-    text = re.sub(r'\s+', ' ', text)
+    text = HTML_TAG_RE.sub(' ', text)
+    text = WHITESPACE_RE.sub(' ', text)
     return text.strip()
 
 def decode_body(body_data):
@@ -27,9 +222,39 @@ def decode_body(body_data):
         body_bytes = base64.urlsafe_b64decode(body_data + '=' * (4 - len(body_data) % 4))
         return body_bytes.decode('utf-8')
     except Exception as e:
-        print(f"Error decoding email body: {e}")
+        logger.error(f"Error decoding email body: {e}")
         return "[Body decoding error]"
 
+def find_part(parts, mime_type):
+    """Find the first part of a MIME type, looking inside nested multipart parts too."""
+    for part in parts:
+        if part['mimeType'] == mime_type:
+            return part
+    for part in parts:
+        if part['mimeType'].startswith('multipart/'):
+            found = find_part(part.get('parts', []), mime_type)
+            if found:
+                return found
+    return None
+
+def extract_body(payload):
+    """Decode a message's text, preferring the plain text part over HTML.
+    
+    Only the chosen part is decoded, so the HTML alternative of a message that
+    also has plain text is never decoded or cleaned.
+    """
+    parts = payload.get('parts')
+    if not parts:
+        return decode_body(payload.get('body', {}).get('data', ''))
+    
+    part = find_part(parts, 'text/plain')
+    if part:
+        return decode_body(part['body'].get('data', ''))
+    part = find_part(parts, 'text/html')
+    if part:
+        return clean_html(decode_body(part['body'].get('data', '')))
+    return ""
+
 def extract_your_content(body, email_date):
     """Extract only the content that the user wrote (not quoted replies)."""
     if not body:
@@ -39,39 +264,6 @@ def extract_your_content(body, email_date):
     lines = body.split('\n')
     your_content = []
     
-    # Common patterns for quoted content start
-    quoted_start_patterns = [
-        r'^On .+ wrote:$',           # Standard Gmail quote format
-        r'^>.+',                     # Line starting with >
-        r'^From: ',                  # Quoted headers
-        r'^Date: ',
-        r'^Subject: ',
-        r'^To: ',
-        r'^Sent from ',              # Common mobile signatures
-        r'^-+Original Message-+',    # Forwarded message markers
-        r'^-+Forwarded message-+',
-        r'^_+',                      # Horizontal rule markers
-    ]
-    
-    # Signature markers - these typically end the user's content
-    signature_patterns = [
-        r'^--\s*$',                  # Standard signature marker
-        r'^__+\s*$',                 # Underscores as signature marker
-        r'^-+\s*$',                  # Dashes as signature marker
-        r'^Regards,\s*$',            # Common signature starter
-        r'^Best,\s*$',               # Common signature starter
-        r'^Thanks,\s*$',             # Common signature starter
-        r'^Thank you,\s*$',          # Common signature starter
-        r'^Sincerely,\s*$',          # Common signature starter
-        r'^Cheers,\s*$',             # Common signature starter
-    ]
-    
-    # Combine start patterns
-    start_pattern = '|'.join(f'({p})' for p in quoted_start_patterns)
-    
-    # Combine signature patterns
-    sig_pattern = '|'.join(f'({p})' for p in signature_patterns)
-    
     in_quote = False
     reached_signature = False
     
@@ -79,20 +271,14 @@ def extract_your_content(body, email_date):
         line_stripped = line.strip()
         
         # Check if this line starts a quote
-        if re.match(start_pattern, line_stripped):
+        if QUOTE_START_RE.match(line_stripped):
             in_quote = True
             continue
         
         # Check if this line is likely a signature marker
-        if not in_quote and your_content and re.match(sig_pattern, line_stripped):
+        if not in_quote and your_content and SIGNATURE_RE.match(line_stripped):
             reached_signature = True
         
-        # Special case: if we see a pattern like "On [date], [name] <[email]> wrote:",
-        # everything after that is a quoted reply
-        if re.match(r'^On .+, .+ wrote:$', line_stripped):
-            in_quote = True
-            continue
-        
         # If we're not in a quote and haven't reached signature, add the line
         if not in_quote and not reached_signature:
             # Skip empty lines at the start
@@ -108,34 +294,89 @@ def extract_your_content(body, email_date):
     result = '\n'.join(your_content)
     
     # Remove common automatic signatures that might not be caught by markers
-    result = re.sub(r'\n+Sent from my iPhone\s*$', '', result)
-    result = re.sub(r'\n+Sent from my Android\s*$', '', result)
-    result = re.sub(r'\n+Get Outlook for (iOS|Android)\s*$', '', result)
+    for pattern in TRAILING_SIGNATURE_RES:
+        result = pattern.sub('', result)
     
     return result.strip()
 
-def fetch_emails(user_id, query="in:sent after:2014/01/01 before:2022/01/01", limit=1000):
-    """Fetch emails from Gmail and store in S3."""
+def header_map(headers):
+    """Map lowercased header names to values, keeping the first of any repeated header."""
+    return {h['name'].lower(): h['value'] for h in reversed(headers)}
+
+def parse_message(msg_id, msg):
+    """Turn a fetched message into a sent_emails.txt entry, or None if the user wrote nothing in it."""
+    headers = header_map(msg['payload']['headers'])
+    date = headers.get('date', 'Unknown')
+    your_content = extract_your_content(extract_body(msg['payload']), date)
+    if not your_content.strip():
+        return None
+    return format_email_entry(msg_id, date, headers.get('to', 'Unknown'),
+                              headers.get('subject', 'No Subject'), your_content)
+
+def _parse_message_safely(msg_id, msg):
+    # Runs in a worker process; errors come back as strings so they always pickle
+    try:
+        return msg_id, parse_message(msg_id, msg), None
+    except Exception as e:
+        return msg_id, None, str(e)
+
+def parse_messages(fetched):
+    """Parse fetch_messages() results with parse_message, spread over worker processes.
+    
+    Returns (msg_id, entry, error) tuples in the same order; fetch errors are passed through.
+    """
+    ok = [(msg_id, msg) for msg_id, msg, error in fetched if error is None]
+    if PROCESS_POOL_SIZE > 1 and len(ok) > 1:
+        chunksize = max(1, len(ok) // (PROCESS_POOL_SIZE * 4))
+        parsed = get_process_pool().map(_parse_message_safely, *zip(*ok), chunksize=chunksize)
+    else:
+        parsed = (_parse_message_safely(msg_id, msg) for msg_id, msg in ok)
+    
+    parsed = iter(parsed)
+    return [(msg_id, None, error) if error is not None else next(parsed)
+            for msg_id, msg, error in fetched]
+
+def start_output_spool(user_id, file_name, resume):
+    """Create the local copy of an output file, starting from the one in S3 when resuming."""
+    local_path = os.path.join(DATA_DIR, user_id, file_name)
+    if resume:
+        try:
+            download_file(user_id, file_name, local_path)
+            return local_path
+        except FileNotFoundError:
+            pass
+    open(local_path, 'w').close()
+    return local_path
+
+def format_email_entry(msg_id, date, to, subject, your_content):
+    """Format one email as a record of the sent_emails.txt corpus."""
+    return (f"Email ID: {msg_id}\nDate: {date}\nTo: {to}\nSubject: {subject}\n"
+            f"Your Content:\n{your_content}\n{EMAIL_SEPARATOR}\n\n")
+
+def fetch_emails(user_id, query="in:sent after:2014/01/01 before:2022/01/01", limit=1000,
+                 update_callback=None):
+    """Fetch emails from Gmail and store in S3, calling update_callback (if given) with progress."""
     # Create the Gmail client
     client = GmailClient(user_id)
     
-    print(f"Fetching emails matching query: {query}")
-    print("This may take a while depending on how many emails you have.")
+    logger.info(f"Fetching emails matching query: {query}")
+    logger.info("This may take a while depending on how many emails you have.")
     
     # Prepare output file names
     output_file = "sent_emails.txt"
     progress_file = "email_fetch_progress.txt"
     
-    # Initialize or read progress
-    processed_ids = set()
-    if file_exists(user_id, progress_file):
-        progress_content = read_file(user_id, progress_file)
-        processed_ids = set(line.strip() for line in progress_content.split('\n') if line.strip())
-        print(f"Resuming from previous run, {len(processed_ids)} emails already processed.")
+    # Initialize or read progress (via the local mirror when it's up to date)
+    processed_ids = ProgressStore(user_id, progress_file)
+    resuming = len(processed_ids) > 0
+    if resuming:
+        logger.info(f"Resuming from previous run, {len(processed_ids)} emails already processed.")
     
-    # Create or clear the output file if no progress
-    if not processed_ids:
-        write_file(user_id, output_file, "")  # Create empty file
+    # Emails are written to a local copy of the output file (a fresh one if no
+    # progress), which is uploaded to S3 once at the end
+    local_output = start_output_spool(user_id, output_file, resuming)
+    out_file = open(local_output, 'a', encoding='utf-8')
+    spooled_ids = []  # Processed IDs, recorded once the output is uploaded
     
     # Initialize counters
     page_token = None
@@ -143,121 +384,111 @@ def fetch_emails(user_id, query="in:sent after:2014/01/01 before:2022/01/01", li
     limit_reached = False
     actual_processed = 0
     
-    # Loop to handle pagination
-    while not limit_reached:
-        # Fetch a batch of emails
-        try:
-            results = client.service.users().messages().list(
-                userId='me',
-                q=query,
-                maxResults=100,
-                pageToken=page_token
-            ).execute()
-        except Exception as e:
-            print(f"Error fetching messages: {e}")
-            print("Waiting 30 seconds before retrying...")
-            time.sleep(30)
-            continue
-        
-        messages = results.get('messages', [])
-        if not messages:
-            print("No more messages to fetch.")
-            break
-            
-        batch_size = len(messages)
-        print(f"Processing batch of {batch_size} emails...")
-        
-        batch_content = ""  # Accumulate content before writing to S3
-        new_processed_ids = ""  # Accumulate processed IDs
-        
-        # Process each message
-        for i, message in enumerate(messages):
-            msg_id = message['id']
-            
-            # Skip if already processed
-            if msg_id in processed_ids:
+    # Loop to handle pagination, listing the next page while the current one
+    # is fetched and processed
+    list_pool = ThreadPoolExecutor(max_workers=1)
+    next_page = list_pool.submit(list_messages_page, client, query, page_token)
+    try:
+        while not limit_reached:
+            # Wait for the page of emails
+            try:
+                results = next_page.result()
+            except Exception as e:
+                logger.error(f"Error fetching messages: {e}")
+                logger.warning("Waiting 30 seconds before retrying...")
+                time.sleep(30)
+                next_page = list_pool.submit(list_messages_page, client, query, page_token)
                 continue
             
-            # Check if we've reached the limit
-            if total_fetched >= limit:
-                print(f"Reached the limit of {limit} emails.")
-                limit_reached = True
+            messages = results.get('messages', [])
+            if not messages:
+                logger.info("No more messages to fetch.")
                 break
-            
-            try:
-                # Get full message details
-                msg = client.service.users().messages().get(
-                    userId='me', id=msg_id, format='full'
-                ).execute()
-                
-                # Extract email details
-                headers = msg['payload']['headers']
-                subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-                to = next((h['value'] for h in headers if h['name'].lower() == 'to'), 'Unknown')
-                date = next((h['value'] for h in headers if h['name'].lower() == 'date'), 'Unknown')
-                
-                # Extract body
-                body = ""
-                if 'parts' in msg['payload']:
-                    for part in msg['payload']['parts']:
-                        if part['mimeType'] == 'text/plain':
-                            body = decode_body(part['body'].get('data', ''))
-                            break
-                        elif part['mimeType'] == 'text/html' and not body:
-                            body = clean_html(decode_body(part['body'].get('data', '')))
-                elif 'body' in msg['payload'] and 'data' in msg['payload']['body']:
-                    body = decode_body(msg['payload']['body'].get('data', ''))
-                
-                # Extract only the content you wrote
-                your_content = extract_your_content(body, date)
-                
-                # Format the email for storage
-                email_entry = f"Email ID: {msg_id}\n"
-                email_entry += f"Date: {date}\n"
-                email_entry += f"To: {to}\n"
-                email_entry += f"Subject: {subject}\n"
-                email_entry += "Your Content:\n"
-                email_entry += your_content
-                email_entry += "\n" + "="*80 + "\n\n"
-                
-                # Add to batch content
-                batch_content += email_entry
-                
-                # Add to processed IDs
-                new_processed_ids += f"{msg_id}\n"
-                
-                # Add to processed set
-                processed_ids.add(msg_id)
-                
-                # Count as processed
-                actual_processed += 1
                 
-                # Progress update
-                if (i + 1) % 10 == 0:
-                    print(f"  Processed {i + 1}/{batch_size} in current batch")
+            # Skip messages already processed, and stop at the limit
+            pending_ids = processed_ids.unprocessed([message['id'] for message in messages])
+            if total_fetched + len(pending_ids) > limit:
+                logger.info(f"Reached the limit of {limit} emails.")
+                pending_ids = pending_ids[:max(0, limit - total_fetched)]
+                limit_reached = True
+            
+            # Request the next page before working on this one
+            next_page_token = results.get('nextPageToken')
+            if next_page_token and not limit_reached:
+                next_page = list_pool.submit(list_messages_page, client, query, next_page_token)
+            
+            batch_size = len(pending_ids)
+            logger.info(f"Processing batch of {batch_size} emails...")
+            
+            batch_entries = []  # Accumulate the page's content before writing it out
+            batch_ids = []  # Accumulate the page's processed IDs
+            
+            # Fetch the page's messages in batch requests and process each one
+            for i, (msg_id, msg, error) in enumerate(fetch_messages(client, pending_ids)):
+                if error:
+                    logger.error(f"Error processing message {msg_id}: {error}")
+                    total_fetched += 1
+                    continue
                 
-                # Write to S3 every 20 emails or at the end
-                if (i + 1) % 20 == 0 or i == batch_size - 1:
-                    if batch_content:
-                        append_to_file(user_id, output_file, batch_content)
-                        append_to_file(user_id, progress_file, new_processed_ids)
-                        batch_content = ""
-                        new_processed_ids = ""
+                try:
+                    # Extract email details
+                    headers = header_map(msg['payload']['headers'])
+                    subject = headers.get('subject', 'No Subject')
+                    to = headers.get('to', 'Unknown')
+                    date = headers.get('date', 'Unknown')
+                    
+                    # Extract body
+                    body = extract_body(msg['payload'])
+                    
+                    # Extract only the content you wrote
+                    your_content = extract_your_content(body, date)
+                    
+                    # Add the formatted email to the batch
+                    batch_entries.append(format_email_entry(msg_id, date, to, subject, your_content))
+                    
+                    # Add to processed IDs
+                    batch_ids.append(msg_id)
+                    
+                    # Count as processed
+                    actual_processed += 1
+                    
+                    # Progress update
+                    if (i + 1) % 10 == 0:
+                        logger.info(f"  Processed {i + 1}/{batch_size} in current batch")
+                        if update_callback:
+                            update_callback(total_fetched, actual_processed, limit_reached)
+                    
+                except Exception as e:
+                    logger.error(f"Error processing message {msg_id}: {e}")
                 
-            except Exception as e:
-                print(f"Error processing message {msg_id}: {e}")
+                # Increment counter
+                total_fetched += 1
             
-            # Increment counter
-            total_fetched += 1
+            # Write the page to the local output in one go
+            if batch_entries:
+                out_file.write("".join(batch_entries))
+                spooled_ids.extend(batch_ids)
             
-            # Sleep briefly to avoid hitting rate limits
-            time.sleep(0.05)
-        
-        # Check if there are more pages
-        page_token = results.get('nextPageToken')
-        if not page_token:
-            print("No more pages to fetch.")
-            break
+            # Check if there are more pages
+            page_token = next_page_token
+            if not page_token:
+                logger.info("No more pages to fetch.")
+                break
+            
+            # Call the update callback after each batch if provided
+            if update_callback:
+                update_callback(total_fetched, actual_processed, limit_reached)
+    finally:
+        try:
+            # Upload the output before recording progress, so emails that never
+            # made it to S3 are fetched again on the next run
+            out_file.close()
+            upload_file(user_id, output_file, local_output)
+            processed_ids.add(spooled_ids)
+        finally:
+            # Clean up even if the upload failed
+            list_pool.shutdown(cancel_futures=True)
+            processed_ids.close()
     
     # Stats about the extraction
     stats = {
@@ -273,9 +504,9 @@ def fetch_emails(user_id, query="in:sent after:2014/01/01 before:2022/01/01", li
     stats_content = "\n".join([f"{k}: {v}" for k, v in stats.items()])
     write_file(user_id, "email_extraction_stats.txt", stats_content)
     
-    print(f"\nCompleted! All emails saved to S3 for user {user_id}")
-    print(f"Total emails processed: {total_fetched}")
-    print(f"Emails with user content extracted: {actual_processed}")
+    logger.info(f"Completed! All emails saved to S3 for user {user_id}")
+    logger.info(f"Total emails processed: {total_fetched}")
+    logger.info(f"Emails with user content extracted: {actual_processed}")
     
     return stats
 
@@ -295,175 +526,11 @@ def main():
     fetch_emails(user_id=args.user_id, query=args.query, limit=args.limit)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     main()
 
 # Add a new function that can be called from the async job
 def async_fetch_emails(user_id, job_id, query="in:sent after:2014/01/01 before:2022/01/01", limit=1000, 
                        update_callback=None):
     """Fetch emails from Gmail with callback for status updates."""
-    # Create the Gmail client
-    client = GmailClient(user_id)
-    
-    print(f"Fetching emails matching query: {query}")
-    print("This may take a while depending on how many emails you have.")
-    
-    # Prepare output file names
-    output_file = "sent_emails.txt"
-    progress_file = "email_fetch_progress.txt"
-    
-    # Initialize or read progress
-    processed_ids = set()
-    if file_exists(user_id, progress_file):
-        progress_content = read_file(user_id, progress_file)
-        processed_ids = set(line.strip() for line in progress_content.split('\n') if line.strip())
-        print(f"Resuming from previous run, {len(processed_ids)} emails already processed.")
-    
-    # Create or clear the output file if no progress
-    if not processed_ids:
-        write_file(user_id, output_file, "")  # Create empty file
-    
-    # Initialize counters
-    page_token = None
-    total_fetched = 0
-    limit_reached = False
-    actual_processed = 0
-    
-    # Loop to handle pagination
-    while not limit_reached:
-        # Fetch a batch of emails
-        try:
-            results = client.service.users().messages().list(
-                userId='me',
-                q=query,
-                maxResults=100,
-                pageToken=page_token
-            ).execute()
-        except Exception as e:
-            print(f"Error fetching messages: {e}")
-            print("Waiting 30 seconds before retrying...")
-            time.sleep(30)
-            continue
-        
-        messages = results.get('messages', [])
-        if not messages:
-            print("No more messages to fetch.")
-            break
-            
-        batch_size = len(messages)
-        print(f"Processing batch of {batch_size} emails...")
-        
-        batch_content = ""  # Accumulate content before writing to S3
-        new_processed_ids = ""  # Accumulate processed IDs
-        
-        # Process each message
-        for i, message in enumerate(messages):
-            msg_id = message['id']
-            
-            # Skip if already processed
-            if msg_id in processed_ids:
-                continue
-            
-            # Check if we've reached the limit
-            if total_fetched >= limit:
-                print(f"Reached the limit of {limit} emails.")
-                limit_reached = True
-                break
-            
-            try:
-                # Get full message details
-                msg = client.service.users().messages().get(
-                    userId='me', id=msg_id, format='full'
-                ).execute()
-                
-                # Extract email details
-                headers = msg['payload']['headers']
-                subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-                to = next((h['value'] for h in headers if h['name'].lower() == 'to'), 'Unknown')
-                date = next((h['value'] for h in headers if h['name'].lower() == 'date'), 'Unknown')
-                
-                # Extract body
-                body = ""
-                if 'parts' in msg['payload']:
-                    for part in msg['payload']['parts']:
-                        if part['mimeType'] == 'text/plain':
-                            body = decode_body(part['body'].get('data', ''))
-                            break
-                        elif part['mimeType'] == 'text/html' and not body:
-                            body = clean_html(decode_body(part['body'].get('data', '')))
-                elif 'body' in msg['payload'] and 'data' in msg['payload']['body']:
-                    body = decode_body(msg['payload']['body'].get('data', ''))
-                
-                # Extract only the content you wrote
-                your_content = extract_your_content(body, date)
-                
-                # Format the email for storage
-                email_entry = f"Email ID: {msg_id}\n"
-                email_entry += f"Date: {date}\n"
-                email_entry += f"To: {to}\n"
-                email_entry += f"Subject: {subject}\n"
-                email_entry += "Your Content:\n"
-                email_entry += your_content
-                email_entry += "\n" + "="*80 + "\n\n"
-                
-                # Add to batch content
-                batch_content += email_entry
-                
-                # Add to processed IDs
-                new_processed_ids += f"{msg_id}\n"
-                
-                # Add to processed set
-                processed_ids.add(msg_id)
-                
-                # Count as processed
-                actual_processed += 1
-                
-                # Call the update callback if provided
-                if update_callback and (i + 1) % 10 == 0:
-                    update_callback(total_fetched, actual_processed, limit_reached)
-                
-                # Write to S3 every 20 emails or at the end
-                if (i + 1) % 20 == 0 or i == batch_size - 1:
-                    if batch_content:
-                        append_to_file(user_id, output_file, batch_content)
-                        append_to_file(user_id, progress_file, new_processed_ids)
-                        batch_content = ""
-                        new_processed_ids = ""
-                
-            except Exception as e:
-                print(f"Error processing message {msg_id}: {e}")
-            
-            # Increment counter
-            total_fetched += 1
-            
-            # Sleep briefly to avoid hitting rate limits
-            time.sleep(0.05)
-        
-        # Check if there are more pages
-        page_token = results.get('nextPageToken')
-        if not page_token:
-            print("No more pages to fetch.")
-            break
-        
-        # Call the update callback after each batch if provided
-        if update_callback:
-            update_callback(total_fetched, actual_processed, limit_reached)
-    
-    # Stats about the extraction
-    stats = {
-        "total_fetched": total_fetched,
-        "actual_processed": actual_processed,
-        "limit_reached": limit_reached,
-        "limit": limit,
-        "query": query,
-        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-    }
-    
-    # Write stats to S3
-    stats_content = "\n".join([f"{k}: {v}" for k, v in stats.items()])
-    write_file(user_id, "email_extraction_stats.txt", stats_content)
-    
-    print(f"\nCompleted! All emails saved to S3 for user {user_id}")
-    print(f"Total emails processed: {total_fetched}")
-    print(f"Emails with user content extracted: {actual_processed}")
-    
-    return stats 
\ No newline at end of file
+    return fetch_emails(user_id, query=query, limit=limit, update_callback=update_callback)
@@ -0,0 +1,37 @@
+"""
+gunicorn.conf.py - Production server configuration for the MailSense API.
+
+    gunicorn -c gunicorn.conf.py
+
+The WSGI app is served from threaded workers (GUNICORN_THREADS per worker).
+gevent workers aren't an option: gevent isn't a dependency, and the app's
+background event loop thread and process pool aren't written for monkey
+patching.
+"""
+
+import os
+import multiprocessing
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', 8080)}"
+
+# Threaded sync workers run the Flask app directly, one request per thread
+worker_class = "gthread"
+wsgi_app = "wsgi:application"
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Job status lives in S3 and OAuth state is signed, so any worker can answer a
+# poll or finish a login - as long as they all share SECRET_KEY. Without it each
+# worker would sign with its own random key, so run a single worker.
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() if os.environ.get('SECRET_KEY') else 1))
+
+# Workers inherit this, so each sizes its process pool (mailsense.pool) to its
+# share of the cores rather than to all of them
+os.environ['WEB_CONCURRENCY'] = str(workers)
+
+# app.py starts a background event loop thread at import; threads don't
+# survive fork, so each worker has to import the app itself
+preload_app = False
+
+# The legacy /api/fetch-history endpoint waits up to 5 minutes for its job
+timeout = 330
+keepalive = 30
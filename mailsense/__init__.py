@@ -0,0 +1 @@
+"""MailSense core: Gmail access, OAuth credentials and per-user S3 storage."""
@@ -2,6 +2,7 @@ import os
 import json
 import pickle
 import webbrowser
+import requests
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
@@ -10,6 +11,10 @@ from mailsense.storage import read_pickle, write_pickle, file_exists
 # If modifying these scopes, delete the token.pickle file
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+# Shared transport for token refreshes so they reuse pooled keep-alive
+# connections to oauth2.googleapis.com instead of a new TLS handshake each time
+refresh_request = Request(session=requests.Session())
+
 def get_credentials():
     """Get valid user credentials from storage or through OAuth flow."""
     creds = None
@@ -30,7 +35,7 @@ def get_credentials():
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             try:
-                creds.refresh(Request())
+                creds.refresh(refresh_request)
                 write_pickle(user_id, token_file, creds)
                 print("Using refreshed credentials")
             except Exception as e:
@@ -1,64 +1,265 @@
 from googleapiclient.discovery import build
-from .auth import get_credentials
+import httplib2
+import google_auth_httplib2
+from .auth import get_credentials, refresh_request
 import os
+import json
 import pickle
-from google.auth.transport.requests import Request
-from .storage import read_pickle, file_exists, write_pickle
+import pickletools
+import threading
+import time
+import functools
+import queue
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict, OrderedDict
+from google.oauth2.credentials import Credentials
+from .storage import read_pickle, write_pickle, read_file, write_file
+
+# Local token storage - configurable for Docker environments
+DATA_DIR = os.environ.get('DATA_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "user_data"))
+TOKENS_DIR = os.path.join(DATA_DIR, 'tokens')
+
+# Token written by the OAuth flow, and the pickle it was stored as before
+CREDENTIALS_FILE = "gmail_credentials.json"
+LEGACY_CREDENTIALS_FILE = "gmail_credentials.pickle"
+
+# Valid credentials kept in-process: user_id -> (credentials, last used time),
+# least recently used first, bounded to CREDENTIALS_CACHE_SIZE users
+CREDENTIALS_CACHE_SIZE = int(os.environ.get('CREDENTIALS_CACHE_SIZE', 1024))
+_credentials_cache = OrderedDict()
+_credentials_cache_lock = threading.Lock()
+# Cached credentials not used for this long are dropped by a periodic sweep
+CREDENTIALS_IDLE_TTL = 48 * 60 * 60
+CREDENTIALS_SWEEP_INTERVAL = 60 * 60
+_sweep_timer = None
+# Per-user locks so concurrent requests don't load or refresh the same token twice
+_credentials_locks = defaultdict(threading.Lock)
+_credentials_locks_guard = threading.Lock()
+# Tokens this close to expiry are refreshed early rather than used
+REFRESH_MARGIN = timedelta(seconds=60)
+
+# Partial response for messages.get: only the parts of the message we read,
+# including one level of nested multipart parts
+MESSAGE_FIELDS = ('id,payload(mimeType,headers(name,value),body/data,'
+                  'parts(mimeType,body/data,parts(mimeType,body/data)))')
+
+# Idle GmailClients by user_id, reused by later jobs while their credentials are current
+_idle_clients = OrderedDict()
+_idle_clients_lock = threading.Lock()
+
+# Directories already created by this process, so we only mkdir once
+_dirs_seen = set()
+_dirs_lock = threading.Lock()
+
+def ensure_dir(path):
+    """Create a directory once per process, skipping the syscall on later calls."""
+    if path in _dirs_seen:
+        return
+    with _dirs_lock:
+        if path not in _dirs_seen:
+            os.makedirs(path, exist_ok=True)
+            _dirs_seen.add(path)
+
+@functools.lru_cache(maxsize=10000)
+def local_token_path(user_id):
+    """Get the path of a user's local token file."""
+    return os.path.join(TOKENS_DIR, f"{user_id}.pickle")
+
+def get_cached_credentials(user_id='default'):
+    """Get a user's cached credentials if they're still valid, otherwise None.
+    
+    Credentials due for a refresh are dropped, so a token that then fails to
+    refresh isn't kept around until the idle sweep.
+    """
+    with _credentials_cache_lock:
+        entry = _credentials_cache.get(user_id)
+        if entry is None:
+            return None
+        creds = entry[0]
+        if needs_refresh(creds):
+            del _credentials_cache[user_id]
+            return None
+        _credentials_cache[user_id] = (creds, time.time())
+        _credentials_cache.move_to_end(user_id)
+        return creds
+
+def cache_credentials(user_id, creds):
+    """Store a user's credentials in the in-process cache, evicting the least recently used."""
+    with _credentials_cache_lock:
+        _credentials_cache[user_id] = (creds, time.time())
+        _credentials_cache.move_to_end(user_id)
+        while len(_credentials_cache) > CREDENTIALS_CACHE_SIZE:
+            _credentials_cache.popitem(last=False)
+    _start_sweep_timer()
+
+def evict_idle_credentials():
+    """Drop cached credentials that haven't been used within CREDENTIALS_IDLE_TTL."""
+    cutoff = time.time() - CREDENTIALS_IDLE_TTL
+    with _credentials_cache_lock:
+        # Entries are in last-used order, so stop at the first recent one
+        while _credentials_cache:
+            _, last_used = next(iter(_credentials_cache.values()))
+            if last_used >= cutoff:
+                break
+            _credentials_cache.popitem(last=False)
+
+def _sweep_idle_credentials():
+    """Timer callback: evict idle credentials and schedule the next sweep."""
+    global _sweep_timer
+    with _credentials_locks_guard:
+        _sweep_timer = None
+    evict_idle_credentials()
+    _start_sweep_timer()
+
+def _start_sweep_timer():
+    """Schedule the idle-eviction sweep if one isn't already pending."""
+    global _sweep_timer
+    with _credentials_locks_guard:
+        if _sweep_timer is None:
+            _sweep_timer = threading.Timer(CREDENTIALS_SWEEP_INTERVAL, _sweep_idle_credentials)
+            _sweep_timer.daemon = True
+            _sweep_timer.start()
+
+def credentials_lock(user_id):
+    """Get the lock that serializes loading and refreshing a user's credentials."""
+    with _credentials_locks_guard:
+        return _credentials_locks[user_id]
+
+def needs_refresh(creds):
+    """Whether credentials are invalid or expire within REFRESH_MARGIN."""
+    if not creds.valid:
+        return True
+    # google-auth stores expiry as naive UTC
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return creds.expiry is not None and creds.expiry - now < REFRESH_MARGIN
+
+def refresh_if_needed(user_id, creds):
+    """Refresh credentials that are expired or about to expire, saving them if they changed."""
+    if needs_refresh(creds):
+        if not creds.refresh_token:
+            raise Exception(f"Invalid credentials for user {user_id}")
+        if refresh_credentials(creds):
+            save_user_credentials(user_id, creds)
+    return creds
+
+def get_valid_credentials(user_id='default'):
+    """Get a user's OAuth credentials from the cache or S3, refreshed if needed.
+    
+    Returns None if the user has no saved credentials. Unlike get_user_credentials
+    this doesn't fall back to legacy token files.
+    """
+    creds = get_cached_credentials(user_id)
+    if creds:
+        return creds
+    
+    with credentials_lock(user_id):
+        # Another request may have loaded or refreshed them while we waited
+        creds = get_cached_credentials(user_id)
+        if creds:
+            return creds
+        
+        creds = read_user_credentials(user_id)
+        if creds is None:
+            return None
+        refresh_if_needed(user_id, creds)
+        cache_credentials(user_id, creds)
+        return creds
 
 def get_user_credentials(user_id='default'):
-    """Get credentials for a specific user."""
-    # First try with the known filename
-    token_file = "gmail_credentials.pickle"  # This is the filename used in the OAuth flow
+    """Get credentials for a specific user, reusing them across calls while valid."""
+    creds = get_cached_credentials(user_id)
+    if creds:
+        return creds
     
-    if file_exists(user_id, token_file):
-        try:
-            creds = read_pickle(user_id, token_file)
-            
-            if not creds.valid:
-                if creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                    write_pickle(user_id, token_file, creds)
-                else:
-                    raise Exception(f"Invalid credentials for user {user_id}")
+    with credentials_lock(user_id):
+        # Another request may have loaded or refreshed them while we waited
+        creds = get_cached_credentials(user_id)
+        if creds:
             return creds
+        
+        creds = load_user_credentials(user_id)
+        cache_credentials(user_id, creds)
+        return creds
+
+def refresh_credentials(creds):
+    """Refresh credentials and report whether the token actually changed (and needs saving)."""
+    old_token, old_expiry = creds.token, creds.expiry
+    creds.refresh(refresh_request)
+    return creds.token != old_token or creds.expiry != old_expiry
+
+def save_user_credentials(user_id, creds):
+    """Save a user's credentials to S3 as authorized-user JSON."""
+    write_file(user_id, CREDENTIALS_FILE, creds.to_json())
+
+def read_user_credentials(user_id='default'):
+    """Read a user's credentials from S3, or None if they have none.
+    
+    Tokens saved as a pickle by older versions are converted to JSON on first read.
+    """
+    try:
+        return Credentials.from_authorized_user_info(json.loads(read_file(user_id, CREDENTIALS_FILE)))
+    except FileNotFoundError:
+        pass
+    
+    try:
+        creds = read_pickle(user_id, LEGACY_CREDENTIALS_FILE)
+    except FileNotFoundError:
+        return None
+    
+    save_user_credentials(user_id, creds)
+    return creds
+
+def load_user_credentials(user_id='default'):
+    """Load credentials for a specific user from storage, refreshing them if expired."""
+    # First try the token saved by the OAuth flow
+    try:
+        creds = read_user_credentials(user_id)
+    except Exception as e:
+        raise Exception(f"Error loading credentials for {user_id}: {str(e)}")
+    
+    if creds:
+        try:
+            return refresh_if_needed(user_id, creds)
         except Exception as e:
             raise Exception(f"Error loading credentials for {user_id}: {str(e)}")
     
     # Try alternate filenames as fallbacks
     alt_token_files = ["gmail_token.pickle", "token.pickle"]
     for alt_file in alt_token_files:
-        if file_exists(user_id, alt_file):
-            try:
-                creds = read_pickle(user_id, alt_file)
-                
-                if not creds.valid:
-                    if creds.expired and creds.refresh_token:
-                        creds.refresh(Request())
+        try:
+            creds = read_pickle(user_id, alt_file)
+            
+            if not creds.valid:
+                if creds.expired and creds.refresh_token:
+                    if refresh_credentials(creds):
                         write_pickle(user_id, alt_file, creds)
-                    else:
-                        continue  # Try next file
-                return creds
-            except Exception:
-                continue  # Try next file
+                else:
+                    continue  # Try next file
+            return creds
+        except Exception:
+            continue  # Try next file (including when it doesn't exist)
     
     # Fallback to local files - configurable for Docker environments
-    data_dir = os.environ.get('DATA_DIR', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "user_data"))
-    tokens_dir = os.path.join(data_dir, 'tokens')
-    os.makedirs(tokens_dir, exist_ok=True)
-    token_path = os.path.join(tokens_dir, f"{user_id}.pickle")
-    
-    if not os.path.exists(token_path):
-        raise Exception(f"No credentials found for user {user_id}")
+    ensure_dir(TOKENS_DIR)
+    token_path = local_token_path(user_id)
     
     try:
         with open(token_path, 'rb') as token:
             creds = pickle.load(token)
-        
+    except FileNotFoundError:
+        raise Exception(f"No credentials found for user {user_id}")
+    except Exception as e:
+        raise Exception(f"Error loading credentials for {user_id}: {str(e)}")
+    
+    try:
         if not creds.valid:
             if creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-                with open(token_path, 'wb') as token:
-                    pickle.dump(creds, token)
+                if refresh_credentials(creds):
+                    # Write to a temp file and swap it in so readers never see a partial token
+                    tmp_path = f"{token_path}.tmp"
+                    with open(tmp_path, 'wb') as token:
+                        token.write(pickletools.optimize(pickle.dumps(creds, protocol=pickle.HIGHEST_PROTOCOL)))
+                    os.replace(tmp_path, token_path)
             else:
                 raise Exception(f"Invalid credentials for user {user_id}")
     except Exception as e:
@@ -69,11 +270,24 @@ def get_user_credentials(user_id='default'):
 class GmailClient:
     """Client to interact with Gmail API."""
     
-    def __init__(self, user_id='default'):
+    def __init__(self, user_id='default', credentials=None):
         """Initialize the Gmail API client."""
         self.user_id = user_id
-        creds = get_user_credentials(user_id)
-        self.service = build('gmail', 'v1', credentials=creds)
+        self.credentials = credentials or get_user_credentials(user_id)
+        self.service = build('gmail', 'v1', credentials=self.credentials)
+        # Authorized connections not currently used by a thread, kept for keep-alive
+        self._idle_http = queue.SimpleQueue()
+    
+    def acquire_http(self):
+        """Take an authorized HTTP connection for one thread's use (httplib2 isn't thread-safe)."""
+        try:
+            return self._idle_http.get_nowait()
+        except queue.Empty:
+            return google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http())
+    
+    def release_http(self, http):
+        """Hand a connection back so the next batch can reuse its open socket."""
+        self._idle_http.put(http)
     
     def get_emails(self, label="SENT", max_results=10):
         """Get emails with the specified label.
@@ -96,15 +310,16 @@ class GmailClient:
         emails = []
         for message in messages:
             msg = self.service.users().messages().get(
-                userId='me', id=message['id'], format='full'
+                userId='me', id=message['id'], format='full', fields=MESSAGE_FIELDS
             ).execute()
             
             # Extract email details
-            headers = msg['payload']['headers']
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-            sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown')
-            to = next((h['value'] for h in headers if h['name'] == 'To'), 'Unknown')
-            date = next((h['value'] for h in headers if h['name'] == 'Date'), 'Unknown')
+            # One pass over the headers (first value wins for repeated names)
+            headers = {h['name'].lower(): h['value'] for h in reversed(msg['payload']['headers'])}
+            subject = headers.get('subject', 'No Subject')
+            sender = headers.get('from', 'Unknown')
+            to = headers.get('to', 'Unknown')
+            date = headers.get('date', 'Unknown')
             
             # Extract body
             body = ""
@@ -130,6 +345,26 @@ class GmailClient:
         
         return emails
 
+def acquire_client(user_id='default'):
+    """Get a GmailClient for a user, reusing an idle one built for their current credentials.
+    
+    The caller has it to itself until it calls release_client.
+    """
+    creds = get_user_credentials(user_id)
+    with _idle_clients_lock:
+        client = _idle_clients.pop(user_id, None)
+    if client is None or client.credentials is not creds:
+        client = GmailClient(user_id, credentials=creds)
+    return client
+
+def release_client(client):
+    """Return a client to the idle pool once the caller is done with it."""
+    with _idle_clients_lock:
+        _idle_clients[client.user_id] = client
+        _idle_clients.move_to_end(client.user_id)
+        while len(_idle_clients) > CREDENTIALS_CACHE_SIZE:
+            _idle_clients.popitem(last=False)
+
 def list_sent_emails():
     """List sent emails as a command-line utility."""
     client = GmailClient()
@@ -0,0 +1,27 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# One pool per process for all CPU-bound work (message parsing, tokenization).
+# Server workers split the cores between them - gunicorn.conf.py exports the
+# worker count as WEB_CONCURRENCY - so the pools of every worker add up to about
+# one process per core. The command-line scripts get every core.
+PROCESS_POOL_SIZE = int(os.environ.get(
+    'PROCESS_POOL_SIZE',
+    max(1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY', 1)))
+))
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def get_process_pool():
+    """Get this process's shared worker pool, creating it on first use."""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # forkserver: the server process has running threads, which makes fork unsafe
+            _process_pool = ProcessPoolExecutor(
+                max_workers=PROCESS_POOL_SIZE,
+                mp_context=multiprocessing.get_context("forkserver")
+            )
+        return _process_pool
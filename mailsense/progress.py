@@ -0,0 +1,81 @@
+import os
+import sqlite3
+from .gmail import DATA_DIR, ensure_dir
+from .storage import read_file, append_to_file, get_file_etag
+
+class ProgressStore:
+    """Processed message IDs for a user, mirrored into a local SQLite database.
+    
+    The progress file in S3 stays the record shared by every instance. The
+    database keeps a copy of it, tagged with the S3 ETag it was synced from, so
+    a resume on the same host only re-reads the file if it changed elsewhere
+    and membership checks don't need every ID held in a Python set.
+    """
+    
+    def __init__(self, user_id, file_name):
+        self.user_id = user_id
+        self.file_name = file_name
+        
+        user_dir = os.path.join(DATA_DIR, user_id)
+        ensure_dir(user_dir)
+        self.conn = sqlite3.connect(os.path.join(user_dir, "fetch_progress.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS processed(id TEXT PRIMARY KEY)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+        self._sync()
+    
+    def _synced_etag(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'etag'").fetchone()
+        return row[0] if row else None
+    
+    def _set_synced_etag(self, etag):
+        self.conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('etag', ?)", (etag,))
+    
+    def _sync(self):
+        """Bring the database in line with the S3 progress file."""
+        etag = get_file_etag(self.user_id, self.file_name)
+        if etag is None:
+            # No progress in S3 means a fresh fetch
+            self.conn.execute("DELETE FROM processed")
+            self.conn.execute("DELETE FROM meta")
+        elif etag != self._synced_etag():
+            # Reload from scratch, so IDs no longer in the S3 file don't stay processed
+            content = read_file(self.user_id, self.file_name)
+            self.conn.execute("DELETE FROM processed")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO processed(id) VALUES (?)",
+                ((line.strip(),) for line in content.split('\n') if line.strip())
+            )
+            self._set_synced_etag(etag)
+        self.conn.commit()
+    
+    def __contains__(self, msg_id):
+        return self.conn.execute("SELECT 1 FROM processed WHERE id = ?", (msg_id,)).fetchone() is not None
+    
+    def unprocessed(self, msg_ids):
+        """Return the IDs that haven't been processed yet, in their original order."""
+        seen = set()
+        # Look IDs up in chunks, within SQLite's limit on bound parameters
+        for start in range(0, len(msg_ids), 500):
+            chunk = msg_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            seen.update(row[0] for row in self.conn.execute(
+                f"SELECT id FROM processed WHERE id IN ({placeholders})", chunk))
+        return [msg_id for msg_id in msg_ids if msg_id not in seen]
+    
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM processed").fetchone()[0]
+    
+    def add(self, msg_ids):
+        """Record message IDs as processed, in S3 first and then locally."""
+        if not msg_ids:
+            return
+        append_to_file(self.user_id, self.file_name, "".join(f"{msg_id}\n" for msg_id in msg_ids))
+        self.conn.executemany("INSERT OR IGNORE INTO processed(id) VALUES (?)", ((msg_id,) for msg_id in msg_ids))
+        self._set_synced_etag(get_file_etag(self.user_id, self.file_name))
+        self.conn.commit()
+    
+    def close(self):
+        self.conn.close()
@@ -1,8 +1,11 @@
 import os
+import time
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 import io
 import pickle
+import pickletools
 
 # Get S3 bucket name from environment variable with a default
 S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME', 'mailusers')
@@ -11,6 +14,9 @@ S3_PREFIX = os.environ.get('S3_PREFIX', 'mailsense')
 # Initialize S3 client
 s3_client = boto3.client('s3')
 
+# Large local files are transferred in parallel 8 MB multipart chunks
+TRANSFER_CONFIG = TransferConfig(multipart_chunksize=8 * 1024 * 1024, max_concurrency=10)
+
 def ensure_bucket_exists():
     """Ensure the S3 bucket exists."""
     try:
@@ -72,6 +78,39 @@ def append_to_file(user_id, file_name, content):
     # Write the new content
     write_file(user_id, file_name, new_content)
 
+def write_file_if(user_id, file_name, content, etag=None):
+    """Write content to a file in S3 only if it doesn't exist yet, or still has the given ETag.
+    
+    Returns the new ETag, or None if the condition failed (another writer got there first).
+    """
+    s3_path = get_s3_path(user_id, file_name)
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    try:
+        response = s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=s3_path,
+                                         Body=content.encode('utf-8'), **condition)
+        return response['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict', 'NoSuchKey'):
+            return None
+        else:
+            raise
+
+def upload_file(user_id, file_name, local_path):
+    """Upload a local file to S3."""
+    s3_path = get_s3_path(user_id, file_name)
+    s3_client.upload_file(local_path, S3_BUCKET_NAME, s3_path, Config=TRANSFER_CONFIG)
+
+def download_file(user_id, file_name, local_path):
+    """Download a file from S3 to a local path."""
+    s3_path = get_s3_path(user_id, file_name)
+    try:
+        s3_client.download_file(S3_BUCKET_NAME, s3_path, local_path, Config=TRANSFER_CONFIG)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            raise FileNotFoundError(f"File not found: {s3_path}")
+        else:
+            raise
+
 def read_pickle(user_id, file_name):
     """Read a pickle file from S3."""
     s3_path = get_s3_path(user_id, file_name)
@@ -88,7 +127,8 @@ def read_pickle(user_id, file_name):
 def write_pickle(user_id, file_name, data):
     """Write pickle data to a file in S3."""
     s3_path = get_s3_path(user_id, file_name)
-    pickled_data = pickle.dumps(data)
+    # Drop unused memo opcodes so the stored pickle is smaller and loads faster
+    pickled_data = pickletools.optimize(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
     s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=s3_path, Body=pickled_data)
 
 def list_files(user_id, prefix=''):
@@ -106,6 +146,16 @@ def list_files(user_id, prefix=''):
     
     return files
 
+def delete_files_older_than(user_id, prefix, max_age):
+    """Delete a user's files under prefix that were last modified more than max_age seconds ago."""
+    s3_path = get_s3_path(user_id, prefix)
+    response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=s3_path)
+    cutoff = time.time() - max_age
+    stale = [{'Key': item['Key']} for item in response.get('Contents', [])
+             if item['LastModified'].timestamp() < cutoff]
+    if stale:
+        s3_client.delete_objects(Bucket=S3_BUCKET_NAME, Delete={'Objects': stale, 'Quiet': True})
+
 def delete_file(user_id, file_name):
     """Delete a file from S3."""
     s3_path = get_s3_path(user_id, file_name)
@@ -121,4 +171,28 @@ def get_file_size(user_id, file_name):
         if e.response['Error']['Code'] == '404':
             raise FileNotFoundError(f"File not found: {s3_path}")
         else:
-            raise 
\ No newline at end of file
+            raise 
+
+def get_file_etag(user_id, file_name):
+    """Get the ETag of a file in S3, or None if it doesn't exist."""
+    s3_path = get_s3_path(user_id, file_name)
+    try:
+        response = s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=s3_path)
+        return response['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] == '404':
+            return None
+        else:
+            raise
+
+def get_file_modified(user_id, file_name):
+    """Get the ETag and last modified time (epoch seconds) of a file in S3, or None if it doesn't exist."""
+    s3_path = get_s3_path(user_id, file_name)
+    try:
+        response = s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=s3_path)
+        return response['ETag'], response['LastModified'].timestamp()
+    except ClientError as e:
+        if e.response['Error']['Code'] == '404':
+            return None
+        else:
+            raise
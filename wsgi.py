@@ -0,0 +1,7 @@
+"""
+wsgi.py - WSGI entry point for the MailSense API, for threaded WSGI servers:
+
+    gunicorn -k gthread --threads 8 wsgi:application
+"""
+
+from app import app as application